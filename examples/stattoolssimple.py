@@ -26,25 +26,25 @@ ygauslvl, intervals = qc.getquantilevertical()
 print '====simple Gaussian===='
 print 'The y-level of the 68% interval:', ygauslvl
 print 'The calculated interval:', intervals
-qc.plot()
+qc.plot(show=True)
 
 # generating data:
 ygaus = np.exp(-0.5 * ((x - 5)) ** 2) + np.exp(-0.5 * ((x + 5)) ** 2)
 qc = quantileCalc(x, ygaus)
 ygauslvl, intervals = qc.getquantilevertical()
 print ygauslvl, intervals
-qc.plot()
+qc.plot(show=True)
 
 # a sin**2 function to test the edge effects
 ysin = np.sin(x) ** 2
 qc = quantileCalc(x, ysin)
 ysinlvl, intervals = qc.getquantilevertical()
 print ysinlvl, intervals
-qc.plot()
+qc.plot(show=True)
 
 # a complicated function:
 ycomp = np.exp(-0.5 * (x / 10 ** 2)) * np.sin(x) ** 2 * x ** 2
 qc = quantileCalc(x, ycomp)
 ycomplvl, intervals = qc.getquantilevertical()
 print ycomplvl, intervals
-qc.plot()
+qc.plot(show=True)
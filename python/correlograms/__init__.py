@@ -17,7 +17,9 @@
 ##############################################################################
 """
  Small library to make correlograms. Pandas contains autocorrelations, but not general cross-correlations.
- Use autocorrelation_plot and crosscorrelation_plot to make plots
+ Use autocorrelation_plot and crosscorrelation_plot to make plots,
+ or crosscorrelation and correlogram for the numbers alone. These live in correlograms.correlations,
+ which does not import matplotlib or pandas; the plotting functions import them when they are called.
 
  The formula for the implemented version of cross-correlate is found here:
  https://en.wikipedia.org/wiki/Cross-correlation#Time_series_analysis
@@ -30,12 +32,18 @@
  Authored by: Lodewijk Nauta for KPMG, 2015-09-15
 """
 
-import numpy as _np
-import matplotlib.pyplot as _plt
-from pandas.tools.plotting import autocorrelation_plot
+from correlations import crosscorrelation, crosscorrelation_chunked, crosscorrelation_matrix, correlogram, \
+    confidence_bands
 
 
-def crosscorrelation_plot(series1, series2, ax=None, **kwds):
+def autocorrelation_plot(series, ax=None, **kwds):
+    """Autocorrelation plot for time series, from pandas.
+    pandas and matplotlib are only imported here, see correlations for the numbers alone."""
+    from pandas.tools.plotting import autocorrelation_plot as _autocorrelation_plot
+    return _autocorrelation_plot(series, ax=ax, **kwds)
+
+
+def crosscorrelation_plot(series1, series2, ax=None, max_lag=None, lag_step=1, **kwds):
     """Cross correlation plot for time series. (Correlogram)
 
     Parameters:
@@ -43,6 +51,8 @@ def crosscorrelation_plot(series1, series2, ax=None, **kwds):
     series1: Time series
     series2: Time series
     ax: Matplotlib axis object, optional
+    max_lag: the largest lag shown, by default the length of the longest series
+    lag_step: the distance between the lags shown
     kwds : keywords
         Options to pass to matplotlib plotting method
 
@@ -55,34 +65,18 @@ def crosscorrelation_plot(series1, series2, ax=None, **kwds):
     -----------
     ax: Matplotlib axis object
     """
-    n1, n2 = len(series1), len(series2)
-    data1, data2 = _np.asarray(series1), _np.asarray(series2)
-    # Pad the shorter data set with zeros [Numerical Recipes 2007, page 649]
-    if n1 > n2:
-        data2 = _np.append(data2, _np.zeros(n1 - n2))
-    elif n2 > n1:
-        data1 = _np.append(data1, _np.zeros(n2 - n1))
-    n = max(n1, n2)
-
+    n = max(len(series1), len(series2))
+    if max_lag is None:
+        max_lag = n
     if ax is None:
-        ax = _plt.gca(xlim=(1, n), ylim=(-1.0, 1.0))
-    mean1, mean2 = _np.mean(data1), _np.mean(data2)
-    c1, c2 = _np.sum((data1 - mean1) ** 2) / \
-        float(n), _np.sum((data2 - mean2) ** 2) / float(n)
-    c1, c2 = _np.sqrt(c1), _np.sqrt(c2)
-
-    def r(h):
-        return ((data1[:n - h] - mean1) *
-                (data2[h:] - mean2)).sum() / n / (c1 * c2)
-    x = _np.arange(n) + 1
-    y = map(r, x)  # Note: In pandas this is called lmap
-    z95 = 1.959963984540054
-    z99 = 2.5758293035489004
-    ax.axhline(y=z99 / _np.sqrt(n), linestyle='--', color='grey')
-    ax.axhline(y=z95 / _np.sqrt(n), color='grey')
+        import matplotlib.pyplot as _plt
+        ax = _plt.gca(xlim=(1, max_lag), ylim=(-1.0, 1.0))
+    x, y, z95, z99 = correlogram(series1, series2, max_lag, lag_step)
+    ax.plot(x, z99, linestyle='--', color='grey')
+    ax.plot(x, z95, color='grey')
     ax.axhline(y=0.0, color='black')
-    ax.axhline(y=-z95 / _np.sqrt(n), color='grey')
-    ax.axhline(y=-z99 / _np.sqrt(n), linestyle='--', color='grey')
+    ax.plot(x, -z95, color='grey')
+    ax.plot(x, -z99, linestyle='--', color='grey')
     ax.set_xlabel("Lag")
     ax.set_ylabel("Correlation")
     ax.plot(x, y, **kwds)
@@ -91,4 +85,5 @@ def crosscorrelation_plot(series1, series2, ax=None, **kwds):
     ax.grid()
     return ax
 
-__all__ = ['autocorrelation_plot', 'crosscorrelation_plot']
+__all__ = ['autocorrelation_plot', 'crosscorrelation', 'crosscorrelation_plot', 'crosscorrelation_matrix',
+           'crosscorrelation_chunked', 'correlogram', 'confidence_bands']
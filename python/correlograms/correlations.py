@@ -0,0 +1,273 @@
+##############################################################################
+#
+# Copyright 2016 KPMG Advisory N.V. (unless otherwise stated)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+##############################################################################
+"""
+ The numbers behind the correlograms, without plotting: cross-correlations, autocorrelations and their
+ confidence bands as numpy arrays. This module does not import matplotlib or pandas, so it can be used in
+ batch jobs on headless machines.
+
+ The correlation at lag h is
+ r(h) = sum_t (x_t - mean_x) (y_{t+h} - mean_y) / n / (sigma_x sigma_y),
+ the shorter series is padded with zeros to the length n of the longer one.
+ Under the hypothesis of no correlation the values are distributed around zero with a standard deviation
+ of 1 / sqrt(n), which gives the 95% and 99% bands.
+"""
+
+import numpy as _np
+
+# The two-sided 95% and 99% quantiles of the normal distribution
+Z95 = 1.959963984540054
+Z99 = 2.5758293035489004
+# crosscorrelation sums the products lag by lag up to this many lags per power of two of the FFT size,
+# beyond that the FFT is faster
+DIRECT_LAGS_PER_LOG2 = 16
+# The same for crosscorrelation_matrix, where the direct sums of all pairs are one matrix product per lag
+DIRECT_MATRIX_LAGS_PER_LOG2 = 40
+# The largest number of values crosscorrelation_matrix transforms back at once
+BLOCK_SIZE = 2 ** 24
+
+
+def _padded(series1, series2):
+    """The two series as arrays of equal length, the shorter one padded with zeros"""
+    n1, n2 = len(series1), len(series2)
+    data1, data2 = _np.asarray(series1), _np.asarray(series2)
+    # Pad the shorter data set with zeros [Numerical Recipes 2007, page 649]
+    if n1 > n2:
+        data2 = _np.append(data2, _np.zeros(n1 - n2))
+    elif n2 > n1:
+        data1 = _np.append(data1, _np.zeros(n2 - n1))
+    return data1, data2
+
+
+def _lagged_sums(a, b, lags, method='auto'):
+    """sum_t a[t] b[t + h] for each of the increasing lags h, over the t for which both exist.
+    See crosscorrelation for the methods."""
+    if len(lags) == 0:
+        return _np.zeros(0)
+    # a transform of at least len(a) + lags and len(b) avoids wrapping around
+    size = 2 ** int(_np.ceil(_np.log2(max(len(a) + lags[-1], len(b), 1))))
+    if method == 'auto':
+        method = 'direct' if len(lags) <= DIRECT_LAGS_PER_LOG2 * _np.log2(size) else 'fft'
+    if method == 'direct':
+        return _np.array([_np.dot(a[:max(0, len(b) - h)], b[h:h + len(a)]) for h in lags])
+    if method == 'fft':
+        spectrum = _np.conj(_np.fft.rfft(a, size)) * _np.fft.rfft(b, size)
+        return _np.fft.irfft(spectrum, size)[lags]
+    raise ValueError("Unknown method " + str(method) + ", choose from 'auto', 'direct' or 'fft'")
+
+
+def crosscorrelation(series1, series2, max_lag=None, lag_step=1, method='auto'):
+    """Cross correlation of two time series, for the lags 1, 1 + lag_step, ... up to max_lag.
+
+    Parameters:
+    -----------
+    series1: Time series
+    series2: Time series
+    max_lag: the largest lag, by default the length n of the longest series
+    lag_step: the distance between the lags
+    method: 'direct' sums the lagged products of each lag, O(n) per lag,
+        'fft' computes all lagged sums at once from zero-padded FFTs, O(n log n),
+        'auto' takes the cheaper of the two for the number of lags
+
+    The shorter series is padded with zeros as in crosscorrelation_plot.
+
+    Returns:
+    -----------
+    array of the correlations at the lags
+    """
+    data1, data2 = _padded(series1, series2)
+    n = len(data1)
+    if max_lag is None:
+        max_lag = n
+    lags = _np.arange(1, max_lag + 1, lag_step)
+    d1, d2 = data1 - _np.mean(data1), data2 - _np.mean(data2)
+    c1, c2 = _np.sqrt(_np.sum(d1 ** 2) / float(n)), _np.sqrt(_np.sum(d2 ** 2) / float(n))
+    # lags of n and more have no overlapping products
+    overlapping = lags[lags < n]
+    sums = _np.zeros(len(lags))
+    sums[:len(overlapping)] = _lagged_sums(d1, d2, overlapping, method)
+    return sums / n / (c1 * c2)
+
+
+def _chunk(series, start, stop):
+    """The values start .. stop of a series as floats, padded with zeros beyond its end"""
+    part = _np.asarray(series[start:min(stop, len(series))], dtype=float)
+    if len(part) < stop - start:
+        part = _np.append(part, _np.zeros(stop - start - len(part)))
+    return part
+
+
+def crosscorrelation_chunked(series1, series2, max_lag, lag_step=1, chunk_size=2 ** 20, method='auto'):
+    """Cross correlation of two time series which do not fit in memory, as crosscorrelation gives it.
+
+    Parameters:
+    -----------
+    series1: Time series, anything with a length that can be sliced into numpy arrays,
+        for example a numpy.memmap of a binary file or an h5py dataset
+    series2: Time series, the same
+    max_lag: the largest lag
+    lag_step: the distance between the lags
+    chunk_size: the number of values read at once
+    method: see crosscorrelation, used for each chunk
+
+    The series are read twice, chunk by chunk: first for their means, then for the centered lagged sums
+    of products and the variances. Each chunk of series1 is combined with the chunk of series2 extended by
+    max_lag values (overlap-save), so the memory use is of the order of chunk_size + max_lag.
+
+    Returns:
+    -----------
+    array of the correlations at the lags 1, 1 + lag_step, ... up to max_lag
+    """
+    n = max(len(series1), len(series2))
+    lags = _np.arange(1, max_lag + 1, lag_step)
+    # lags of n and more have no overlapping products
+    overlapping = lags[lags < n]
+    extension = overlapping[-1] if len(overlapping) else 0
+    starts = range(0, n, chunk_size)
+
+    mean1 = sum(_chunk(series1, start, min(start + chunk_size, n)).sum() for start in starts) / float(n)
+    mean2 = sum(_chunk(series2, start, min(start + chunk_size, n)).sum() for start in starts) / float(n)
+    sums = _np.zeros(len(overlapping))
+    c1, c2 = 0.0, 0.0
+    for start in starts:
+        stop = min(start + chunk_size, n)
+        d1 = _chunk(series1, start, stop) - mean1
+        d2 = _chunk(series2, start, min(stop + extension, n)) - mean2
+        sums += _lagged_sums(d1, d2, overlapping, method)
+        c1 += _np.dot(d1, d1)
+        c2 += _np.dot(d2[:stop - start], d2[:stop - start])
+    c1, c2 = _np.sqrt(c1 / float(n)), _np.sqrt(c2 / float(n))
+    result = _np.zeros(len(lags))
+    result[:len(overlapping)] = sums
+    return result / n / (c1 * c2)
+
+
+def confidence_bands(n, nlags):
+    """The 95% and 99% confidence bands of the correlations of series of length n,
+    as arrays for nlags lags"""
+    return _np.full(nlags, Z95 / _np.sqrt(n)), _np.full(nlags, Z99 / _np.sqrt(n))
+
+
+def correlogram(series1, series2=None, max_lag=None, lag_step=1):
+    """The numbers of a correlogram, without plotting.
+
+    Parameters:
+    -----------
+    series1: Time series
+    series2: Time series, by default series1 itself for the autocorrelation
+    max_lag: the largest lag, by default the length n of the longest series
+    lag_step: the distance between the lags
+
+    Returns:
+    -----------
+    lags, correlations, z95, z99: arrays over the lags 1, 1 + lag_step, ... up to max_lag,
+    z95 and z99 are the confidence bands (see confidence_bands)
+    """
+    if series2 is None:
+        series2 = series1
+    n = max(len(series1), len(series2))
+    if max_lag is None:
+        max_lag = n
+    y = crosscorrelation(series1, series2, max_lag, lag_step)
+    z95, z99 = confidence_bands(n, len(y))
+    return _np.arange(1, max_lag + 1, lag_step), y, z95, z99
+
+
+# The centered series or their transforms, shared with the worker processes of crosscorrelation_matrix
+_SHARED = {}
+
+
+def _init_shared(data, lags, size, method):
+    _SHARED.update(data=data, lags=lags, size=size, method=method)
+
+
+def _matrix_rows(rows):
+    """The lagged sums of products of the series start .. stop with all series, a (stop - start, k, lags) array"""
+    start, stop = rows
+    data, lags, size, method = _SHARED['data'], _SHARED['lags'], _SHARED['size'], _SHARED['method']
+    k = data.shape[1]
+    sums = _np.empty((stop - start, k, len(lags)))
+    if method == 'direct':
+        n = data.shape[0]
+        for l, h in enumerate(lags):
+            sums[:, :, l] = _np.dot(data[:n - h, start:stop].T, data[h:])
+        return sums
+    # data holds the transforms, the products with one series are transformed back for blocks of the others
+    columns = max(1, BLOCK_SIZE // size)
+    for i in range(start, stop):
+        for j in range(0, k, columns):
+            spectra = _np.conj(data[:, i])[:, _np.newaxis] * data[:, j:j + columns]
+            sums[i - start, j:j + columns] = _np.fft.irfft(spectra, size, axis=0)[lags].T
+    return sums
+
+
+def crosscorrelation_matrix(df, max_lag, lag_step=1, method='auto', n_jobs=1):
+    """Cross correlations of all pairs of a set of time series of equal length.
+
+    Parameters:
+    -----------
+    df: DataFrame or 2-D array with the series as columns
+    max_lag: the largest lag
+    lag_step: the distance between the lags
+    method: as in crosscorrelation, 'direct' computes the sums of all pairs as one matrix product per lag,
+        'fft' transforms each series once and transforms back the products of the spectra of the pairs
+    n_jobs: the number of processes to spread the series over, -1 for all cores
+
+    The means and standard deviations of the series are computed once.
+
+    Returns:
+    -----------
+    (k, k, lags) array, element [i, j] are the correlations of series i with series j
+    as crosscorrelation(series_i, series_j, max_lag, lag_step) gives them
+    """
+    data = _np.asarray(df, dtype=float)
+    n, k = data.shape
+    lags = _np.arange(1, max_lag + 1, lag_step)
+    overlapping = lags[lags < n]
+    data = data - data.mean(axis=0)
+    c = _np.sqrt(_np.sum(data ** 2, axis=0) / float(n))
+    size = 2 ** int(_np.ceil(_np.log2(max(n + (overlapping[-1] if len(overlapping) else 0), 1))))
+    if method == 'auto':
+        method = 'direct' if len(overlapping) <= DIRECT_MATRIX_LAGS_PER_LOG2 * _np.log2(size) else 'fft'
+    if method == 'fft':
+        data = _np.fft.rfft(data, size, axis=0)
+    elif method != 'direct':
+        raise ValueError("Unknown method " + str(method) + ", choose from 'auto', 'direct' or 'fft'")
+
+    if n_jobs == -1:
+        import multiprocessing
+        n_jobs = multiprocessing.cpu_count()
+    n_jobs = max(1, min(n_jobs or 1, k))
+    bounds = _np.linspace(0, k, n_jobs + 1).astype(int)
+    tasks = zip(bounds[:-1], bounds[1:])
+    if n_jobs == 1:
+        _init_shared(data, overlapping, size, method)
+        try:
+            parts = map(_matrix_rows, tasks)
+        finally:
+            _SHARED.clear()
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(n_jobs, _init_shared, (data, overlapping, size, method))
+        try:
+            parts = pool.map(_matrix_rows, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    result = _np.zeros((k, k, len(lags)))
+    result[:, :, :len(overlapping)] = _np.concatenate(parts)
+    return result / n / (c[:, _np.newaxis, _np.newaxis] * c[_np.newaxis, :, _np.newaxis])
@@ -18,13 +18,21 @@
 """
 Stattools is a collection of statistical methods which don't otherwise appear in numpy/root/r
 
-At the moment, we have two sub modules:
+At the moment, we have three sub modules:
 - confidencecalc: calculate a multi-edge configence window based on confidence levels
    finds an area around the peak containing x% of the points
    by gradually lowering a watershed line through the data
    Copes with none monotonous data.
+   With method="sorted" the level is read off the sorted density in one vectorized pass instead.
+   streamingQuantileCalc keeps these results up to date for a histogram which is filled over time,
+   quantileCalcND finds the highest density region of a 2D or ND density grid.
+   getquantileleft, getquantileright, getquantilecentral and getquantilevertical do the same for ROOT histograms,
+   directly on the histogram buffers.
    See the example notebook for more information and usage
 
 - hypergeometrictools: simple helper functions for hypergeometric calculations
+   and a correlation test for 2D histograms, from numpy arrays, scipy.sparse matrices or ROOT TH2 histograms
+
+- roothistos: views of the bin contents and integrals of ROOT histograms as numpy arrays
 """
-from confidencecalc import quantileCalc
+from confidencecalc import quantileCalc, streamingQuantileCalc, quantileCalcND
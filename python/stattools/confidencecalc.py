@@ -15,10 +15,10 @@
 #   limitations under the License.
 #
 ##############################################################################
-from scipy.interpolate import InterpolatedUnivariateSpline
+from scipy.interpolate import splrep, splev, splint, sproot, splantider
 import numpy as np
 import matplotlib.pyplot as plt
-import matplotlib.path as mpath
+import roothistos
 
 
 class quantileCalc(object):
@@ -37,54 +37,243 @@ class quantileCalc(object):
     ygauslvl, intervals = qc.getquantilevertical()
     print  ygauslvl, intervals
     -plotting-
-    qc.plot()
+    qc.plot(show=True)
+    -or many results at once, into image files-
+    quantileCalc.plot_many([qc1, qc2, qc3], 'quantiles.pdf')
+    -exact highest density region, from the sorted density in one pass-
+    qc = quantileCalc(x, ygaus, method="sorted")
+    -several confidence levels at once-
+    qc = quantileCalc(x, ygaus, levels=[0.682, 0.954, 0.997])
+    for lvl, (ylevel, intervals) in sorted(qc.getquantiles().items()):
+        print lvl, ylevel, intervals
+    -solving until the mass is within a tolerance, and the cost of doing so-
+    qc = quantileCalc(x, ygaus, tol=1e-6)
+    niter, mass = qc.getconvergence()[qc.level]
 
     """
 
-    def __init__(self, xpts, ypts, lvl=0.682, numiter=30):
+    methods = ["spline", "sorted"]
+
+    def __init__(self, xpts, ypts, lvl=0.682, numiter=30, method="spline", levels=None, tol=None):
         """
         The constructor:
-        It takes the input variables and stores them. It also normalizes the data and computes the vertical quantiles.
+        It takes the input variables and stores them. The normalization and the vertical quantiles are computed
+        lazily, on first access to the results (getquantilevertical, getquantiles, plot or the y attribute).
 
         - xpts: a numpy array with the x points of the data
         - ypts: a numpy array with the y points of the data
         - lvl: the requested confidence interval
-        - numiter: the number of iterations
+        - numiter: the number of iterations (only used by the spline method), the maximum number if tol is given
+        - method: "spline" lowers a watershed line through a splined representation of the data,
+                  "sorted" sorts the density once and reads the level off the cumulative sum of the bin areas,
+                  the interval edges are then linearly interpolated on the original grid
+        - levels: a list of requested confidence intervals, replacing lvl. They are all computed in one pass,
+                  sharing the normalized data, the spline and the sorted density.
+                  getquantilevertical returns the first one, getquantiles returns them all
+        - tol: if given, the spline method brackets the level between the minimum and the maximum of the data
+               and stops as soon as the enclosed mass is within tol of the requested level,
+               instead of taking numiter (at least 1) steps. getconvergence reports the cost and the achieved mass.
+               The sorted method does not iterate and does not accept tol.
         """
+        if method not in self.methods:
+            raise ValueError("Unknown method '" + str(method) + "', choose from " + str(self.methods))
+        if tol is not None:
+            if method != "spline":
+                raise ValueError("tol is only used by the spline method, not by '" + str(method) + "'")
+            if numiter < 1:
+                raise ValueError("With tol, numiter is the maximum number of iterations and must be at least 1")
         self.x = xpts
-        self.y = ypts
-        self.level = lvl
+        self.levels = [lvl] if levels is None else list(levels)
+        self.level = self.levels[0]
         self.niter = numiter
-        self.__normalize()
-        self.ylevel, self.intervals = self.__calcquantile_vertical()
+        self.method = method
+        self.tol = tol
+        self.__ypts = ypts
+        self.__y = None
+        self.__tck = None
+        self.__tckint = None
+        self.__quantiles = None
+        self.__convergence = None
+
+    @property
+    def y(self):
+        """The normalized y points"""
+        if self.__y is None:
+            self.__normalize()
+        return self.__y
+
+    @property
+    def quantiles(self):
+        """Dictionary of each requested level to its (ylevel, intervals) pair"""
+        if self.__quantiles is None:
+            if self.method == "sorted":
+                self.__quantiles, self.__convergence = self.__calcquantiles_sorted()
+            else:
+                tck = self.__spline()
+                solve = self.__calcquantile_vertical if self.tol is None else self.__solvequantile_vertical
+                self.__quantiles, self.__convergence = {}, {}
+                for level in self.levels:
+                    ylow, points, niter, mass = solve(level, tck)
+                    self.__quantiles[level] = (ylow, points)
+                    self.__convergence[level] = (niter, mass)
+        return self.__quantiles
+
+    @property
+    def ylevel(self):
+        return self.quantiles[self.level][0]
+
+    @property
+    def intervals(self):
+        return self.quantiles[self.level][1]
+
+    def plot(self, ax=None, show=False):
+        """
+        Draws the normalized data, the level and the hatched area above it.
 
-    def plot(self):
-        Path = mpath.Path
-        fig, ax = plt.subplots()
-        xmin = self.x.min()
-        xmax = self.x.max()
+        - ax: the matplotlib axes to draw on, by default a new figure is made
+        - show: call plt.show() when done, which blocks outside of notebooks
 
-        path_data = [(Path.MOVETO, (xmin, self.ylevel)), (Path.LINETO, (xmax, self.ylevel))]
-        x_lvl, y_lvl = self.__mkpaths(path_data)
+        Returns the axes
+        """
+        if ax is None:
+            fig, ax = plt.subplots()
+        ax.plot(self.x, self.y, 'r-')
+        ax.plot([self.x.min(), self.x.max()], [self.ylevel, self.ylevel], 'g-')
+        ax.fill_between(self.x, self.y, where=self.y > self.ylevel, interpolate=True, hatch='/')
+        if show:
+            plt.show()
+        return ax
+
+    @staticmethod
+    def plot_many(calcs, path, nrows=4, ncols=4, figsize=None):
+        """
+        Draws many quantile results in multi-panel figures and saves them, without pyplot or a GUI.
+        One figure is made on the Agg backend, its axes and lines are reused for every page.
 
-        x_border, y_border = self.__mkpaths(path_data)
+        - calcs: a list of quantileCalc objects
+        - path: the output file. A .pdf file gets one page per figure, for other formats the path needs a {0},
+                which is replaced by the page number, if there is more than one page
+        - nrows, ncols: the number of panels on a page
+        - figsize: the size of a page in inches, 4 by 3 per panel by default
 
-        plt.plot(self.x, self.y, 'r-', x_border, y_border, 'g-', x_lvl, y_lvl, 'g-')
+        Returns the list of files written
+        """
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.backends.backend_pdf import PdfPages
+        perpage = nrows * ncols
+        npages = (len(calcs) + perpage - 1) // perpage
+        pdf = path.lower().endswith('.pdf')
+        if not pdf and npages > 1 and path.format(0) == path:
+            raise ValueError("Writing " + str(npages) + " pages needs a {0} in the path, or a .pdf file")
+        fig = Figure(figsize=figsize or (4 * ncols, 3 * nrows))
+        FigureCanvasAgg(fig)
+        axes = [fig.add_subplot(nrows, ncols, i + 1) for i in range(perpage)]
+        curves = [ax.plot([], [], 'r-')[0] for ax in axes]
+        lines = [ax.plot([], [], 'g-')[0] for ax in axes]
+        fills = [None] * perpage
+        pages = PdfPages(path) if pdf else None
+        written = []
+        try:
+            for page in range(npages):
+                for i, ax in enumerate(axes):
+                    if fills[i] is not None:
+                        fills[i].remove()
+                        fills[i] = None
+                    n = page * perpage + i
+                    ax.set_visible(n < len(calcs))
+                    if n >= len(calcs):
+                        continue
+                    qc = calcs[n]
+                    curves[i].set_data(qc.x, qc.y)
+                    lines[i].set_data([qc.x.min(), qc.x.max()], [qc.ylevel, qc.ylevel])
+                    fills[i] = ax.fill_between(qc.x, qc.y, where=qc.y > qc.ylevel, interpolate=True, hatch='/')
+                    ax.relim()
+                    ax.autoscale_view()
+                if pdf:
+                    pages.savefig(fig)
+                else:
+                    fig.savefig(path.format(page))
+                    written.append(path.format(page))
+        finally:
+            if pages is not None:
+                pages.close()
+        return [path] if pdf else written
+
+    @staticmethod
+    def batch(x, Y, levels=(0.682,), n_jobs=1):
+        """
+        Computes the vertical quantiles of many curves sampled on the same x grid at once, with the sorted method.
+        The normalization and the level finding are vectorized across the curves.
 
-        plt.fill_between(self.x, self.y, where=self.y > self.ylevel, interpolate=True, hatch='/')
+        - x: a numpy array with the x points shared by all curves
+        - Y: a numpy array of shape (n_curves, n_points) with the y points of each curve
+        - levels: the requested confidence intervals
+        - n_jobs: the number of worker processes the curves are split over in blocks, -1 for all cores,
+                  at most one per curve
 
-        plt.show()
+        Returns an array with the y-levels, of shape (n_curves, n_levels),
+        and per curve a list with the array of intervals for each level
+        """
+        Y = np.atleast_2d(np.asarray(Y, dtype=float))
+        levels = list(levels)
+        if len(Y) == 0:
+            return np.empty((0, len(levels))), []
+        import multiprocessing
+        if n_jobs == -1:
+            n_jobs = multiprocessing.cpu_count()
+        n_jobs = min(n_jobs or 1, len(Y))
+        if n_jobs < 2:
+            return _batch_quantiles(x, Y, levels)
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            results = pool.map(_batch_worker, [(x, block, levels) for block in np.array_split(Y, n_jobs)])
+        finally:
+            pool.close()
+            pool.join()
+        ylevels = np.concatenate([r[0] for r in results])
+        intervals = [curve for r in results for curve in r[1]]
+        return ylevels, intervals
 
     def getquantilevertical(self):
         return self.ylevel, self.intervals
 
-    def __mkpaths(self, path_data):
-        codes, verts = zip(*path_data)
-        path = mpath.Path(verts, codes)
-        x, y = zip(*path.vertices)
-        return x, y
+    def getquantiles(self):
+        """
+        Returns a dictionary of each requested level to its (ylevel, intervals) pair
+        """
+        return self.quantiles
+
+    def getconvergence(self):
+        """
+        Returns a dictionary of each requested level to the number of iterations used
+        and the mass actually enclosed by its intervals
+        """
+        self.quantiles
+        return self.__convergence
+
+    def __spline(self):
+        """
+        The interpolating cubic spline through the normalized data, as a (knots, coefficients, degree) tuple.
+        It is built once and cached, the spline of y - ylow only differs by a shift of the coefficients.
+        """
+        if self.__tck is None:
+            self.__tck = splrep(self.x, self.y, s=0)
+        return self.__tck
+
+    def __antiderivative(self):
+        """
+        The cumulative integral of the normalized spline, itself a spline, built once and cached
+        """
+        if self.__tckint is None:
+            self.__tckint = splantider(self.__spline())
+        return self.__tckint
+
+    def __roots(self, tck, ylow):
+        t, c, k = tck
+        return sproot((t, c - ylow, k), mest=3 * (len(t) - 7))
 
-    def __calcquantile_vertical(self):
+    def __calcquantile_vertical(self, level, datarep):
         # start from the max value
         ymax = self.y.max()
         ymin = self.y.min()
@@ -93,13 +282,13 @@ class quantileCalc(object):
         raiselvl = lambda ylvl, step: adjustlvl(ylvl, ymax, step)
         lowerlvl = lambda ylvl, step: adjustlvl(ylvl, ymax, -step)
 
-        # create the splined dataset representation
-        datarep = InterpolatedUnivariateSpline(self.x, self.y)
+        cumrep = self.__antiderivative()
 
         # walk downwards and compute integral
         step = 0.5
         ylow = raiselvl(ymin, step)
         points = []
+        integral = 0.0
 
         prevdiff = -1
         prevstep = step
@@ -107,21 +296,21 @@ class quantileCalc(object):
 
         for i in range(self.niter):
             # create the splined dataset and solve for the roots
-            points = self.__getpoints(InterpolatedUnivariateSpline(self.x, self.y - ylow).roots(), datarep)
+            points = self.__getpoints(self.__roots(datarep, ylow), datarep)
             # print 'points', points
-            integral = self.__compute_integral(points, datarep)
-            diff = abs(integral - self.level)
+            integral = self.__compute_integral(points, cumrep)
+            diff = abs(integral - level)
             # print step, ylow, diff
 
             if prevdiff > diff:
                 # wrong direction: go back and take a smaller step
                 ylow = prevylow
                 step = step / 2.0
-                points = self.__getpoints(InterpolatedUnivariateSpline(self.x, self.y - ylow).roots(), datarep)
-                integral = self.__compute_integral(points, datarep)
+                points = self.__getpoints(self.__roots(datarep, ylow), datarep)
+                integral = self.__compute_integral(points, cumrep)
 
             # if integral larger than level, raise lower bound
-            if integral > self.level:
+            if integral > level:
                 ylow = raiselvl(ylow, step)
                 # if integral smaller than level, lower the lower bound
             else:
@@ -131,44 +320,604 @@ class quantileCalc(object):
             prevstep = step
             prevdiff = diff
 
-        return ylow, np.array(points)
+        return ylow, points, self.niter, integral
+
+    def __solvequantile_vertical(self, level, datarep):
+        """
+        Bracketing solver on the mass above the level minus the requested mass, which decreases with the level.
+        Uses the Illinois variant of regula falsi, which keeps the bracket but converges superlinearly,
+        and stops as soon as the mass is within tol of the requested level, or after numiter iterations.
+        """
+        cumrep = self.__antiderivative()
+        # the whole (normalized) mass is above the minimum, nothing is above the maximum
+        lo, flo = self.y.min(), 1.0 - level
+        hi, fhi = self.y.max(), -level
+        side = 0
+        for i in range(1, self.niter + 1):
+            ylow = (lo * fhi - hi * flo) / (fhi - flo)
+            points = self.__getpoints(self.__roots(datarep, ylow), datarep)
+            diff = self.__compute_integral(points, cumrep) - level
+            if abs(diff) <= self.tol:
+                break
+            if diff > 0:
+                # too much mass, raise the lower end of the bracket
+                lo, flo = ylow, diff
+                if side == 1:
+                    fhi /= 2.0
+                side = 1
+            else:
+                hi, fhi = ylow, diff
+                if side == -1:
+                    flo /= 2.0
+                side = -1
+        return ylow, points, i, diff + level
+
+    def __calcquantiles_sorted(self, nsteps=2):
+        y = self.y[np.newaxis, :]
+        ylows = _hpd_levels(y, _bin_widths(self.x), self.levels)
+        quantiles, convergence = {}, {}
+        for j, level in enumerate(self.levels):
+            ylow = _polish_levels(self.x, y, ylows[:, j], level, nsteps)
+            quantiles[level] = (ylow[0], _level_crossings(self.x, y, ylow)[0])
+            convergence[level] = (nsteps, _mass_above(self.x, y, ylow)[0][0])
+        return quantiles, convergence
 
     def __normalize(self):
-        val = InterpolatedUnivariateSpline(self.x, self.y).integral(self.x.min(), self.x.max())
-        self.y = self.y / val
+        if self.method == "sorted":
+            val = (self.__ypts * _bin_widths(self.x)).sum()
+        else:
+            # the spline through the raw data is normalized along with the data, instead of being refitted
+            t, c, k = splrep(self.x, self.__ypts, s=0)
+            val = splint(self.x.min(), self.x.max(), (t, c, k))
+            self.__tck = (t, c / val, k)
+        self.__y = self.__ypts / val
 
     def __compute_integral(self, points, data):
-        val = 0
-        for x1, x2 in points:
-            val += data.integral(x1, x2)
-        return val
+        # data is the cumulative integral, evaluated at all interval edges at once
+        return (splev(points[:, 1], data) - splev(points[:, 0], data)).sum()
 
     def __getpoints(self, rootlist, thedata):
-        points = []
         # There must be a positive integral between two points
         # two cases:
         # 1) begin and end root are edge-values
-        theder = lambda x: thedata.derivatives(x)[1]
         if len(rootlist) == 0:
-            return [(self.x.min(), self.x.max())]
-        if (theder(rootlist[0]) < 0) & (theder(rootlist[-1]) < 0):
-            # only begin edge effects
-            points = [(self.x.min(), rootlist[0])]
-            rootlist = np.delete(rootlist, 0)
-        elif (theder(rootlist[0]) > 0) & (theder(rootlist[-1]) > 0):
-            # only end edge effects
-            points = [(rootlist[-1], self.x.max())]
-            rootlist = np.delete(rootlist, -1)
-        elif (theder(rootlist[0]) > 0) & (theder(rootlist[-1]) > 0):
-            # both begin and end edge effects
-            points = [(self.x.min(), rootlist[0]), (rootlist[-1], self.x.max())]
-            rootlist = np.delete(rootlist, 0)
-            rootlist = np.delete(rootlist, -1)
-
-        for i in range(0, len(rootlist), 2):
-            points.append((rootlist[i], rootlist[i + 1]))
-
-        return points
+            return np.array([(self.x.min(), self.x.max())])
+        # the slopes at all roots in one evaluation
+        theder = splev(rootlist, thedata, der=1)
+        edges = np.asarray(rootlist)
+        if theder[0] < 0:
+            # begin edge effects
+            edges = np.concatenate(([self.x.min()], edges))
+        if theder[-1] > 0:
+            # end edge effects
+            edges = np.concatenate((edges, [self.x.max()]))
+        return edges.reshape(-1, 2)
+
+
+class streamingQuantileCalc(object):
+    """
+    Calculates the same vertical confidence intervals as quantileCalc(..., method="sorted"), for a histogram which
+    is filled over time. The bins are histogram bins: each count fills the full width of its bin, the first and last
+    bins included.
+
+    The bins are kept sorted by density in blocks of about sqrt(n) bins which know their number of entries
+    (see _sortedBins), and for every level the segments between neighbouring bins which cross it are remembered.
+    An update moves the changed bins through the blocks, a query reads the level off the block counts and only
+    revisits the segments next to the changed bins and to the bins between the old and the new level. After a small
+    update both cost of the order of sqrt(n), plus the number of segments crossing the levels, instead of n.
+
+    USAGE:
+    -The bin centres-
+    x = np.linspace(-5, 5, 1001)
+    sqc = streamingQuantileCalc(x)
+    -Add entries, as bin indices with (optional) weights-
+    sqc.update(np.searchsorted(x, np.random.normal(size=1000)).clip(0, 1000))
+    -the results, for the current content-
+    ylevel, intervals = sqc.getquantilevertical()
+    -or with the actual bin edges, for variable binning-
+    sqc = streamingQuantileCalc(x, edges=np.linspace(-5.005, 5.005, 1002))
+
+    """
+
+    def __init__(self, xpts, counts=None, lvl=0.682, levels=None, edges=None, nsteps=2):
+        """
+        The constructor:
+        - xpts: a numpy array with the bin centres
+        - counts: a numpy array with the initial content of each bin, empty by default
+        - lvl: the requested confidence interval
+        - levels: a list of requested confidence intervals, replacing lvl
+        - edges: a numpy array with the bin edges, one more than the bins. By default the edges lie half way between
+                 the centres, and half a bin beyond the first and last centre.
+        - nsteps: the number of Newton steps which polish the levels, as in _polish_levels
+        """
+        self.x = xpts
+        self.edges = _histogram_edges(xpts) if edges is None else np.asarray(edges, dtype=float)
+        if len(self.edges) != len(xpts) + 1:
+            raise ValueError("Expected " + str(len(xpts) + 1) + " bin edges, got " + str(len(self.edges)))
+        self.widths = np.diff(self.edges)
+        self.counts = np.zeros(len(xpts)) if counts is None else np.array(counts, dtype=float)
+        self.levels = [lvl] if levels is None else list(levels)
+        self.level = self.levels[0]
+        self.nsteps = nsteps
+        self.__total = self.counts.sum()
+        # the unnormalized density, in entries per unit of x
+        self.__density = self.counts / self.widths
+        self.__sorted = _sortedBins(self.__density, self.counts)
+        # for every requested level: the last density level and the set of segments (i, i + 1) crossing it
+        self.__crossings = {}
+        self.__changed = np.zeros(0, dtype=int)
+        self.__quantiles = None
+
+    def update(self, bin_indices, weights=None):
+        """
+        Adds weights (one per entry by default) to the given bins and moves the changed bins through the sorted
+        blocks, at a cost of the order of sqrt(n) per changed bin.
+        """
+        bin_indices = np.asarray(bin_indices, dtype=int)
+        if weights is None:
+            weights = np.ones(len(bin_indices))
+        changed = np.unique(bin_indices)
+        self.__sorted.remove(changed)
+        np.add.at(self.counts, bin_indices, weights)
+        self.__total += np.sum(weights)
+        self.__density[changed] = self.counts[changed] / self.widths[changed]
+        self.__sorted.insert(changed)
+        self.__changed = np.union1d(self.__changed, changed)
+        self.__quantiles = None
+
+    @property
+    def y(self):
+        """The normalized density, zero while the histogram is empty"""
+        total = self.counts.sum()
+        return self.counts / self.widths / (total if total > 0 else 1.0)
+
+    def getquantiles(self):
+        """
+        Returns a dictionary of each requested level to its (ylevel, intervals) pair, for the current content.
+        While the histogram is empty every level is 0.0, without intervals.
+        """
+        if self.__total <= 0:
+            return dict((level, (0.0, np.empty((0, 2)))) for level in self.levels)
+        if self.__quantiles is None:
+            self.__quantiles = {}
+            for level in self.levels:
+                ylevel, crossings = self.__solve(level)
+                self.__quantiles[level] = (ylevel / self.__total, self.__intervals(ylevel, crossings))
+            self.__changed = np.zeros(0, dtype=int)
+        return self.__quantiles
+
+    def getquantilevertical(self):
+        return self.getquantiles()[self.level]
+
+    def __solve(self, level):
+        """
+        The density level enclosing the fraction level of the entries and the segments crossing it: the estimate
+        from the sorted blocks, polished by Newton steps on the area above the level as in _polish_levels
+        """
+        target = level * self.__total
+        dmin, dmax = self.__sorted.extremes()
+        ylevel = self.__sorted.level(target)
+        if level in self.__crossings:
+            previous, crossings = self.__crossings[level]
+            crossings = self.__move(crossings, previous, ylevel, self.__changed)
+        else:
+            above = self.__density >= ylevel
+            crossings = set(np.flatnonzero(above[1:] != above[:-1]).tolist())
+        for i in range(self.nsteps):
+            mass, slope = self.__mass_above(ylevel, crossings)
+            step = (mass - target) / slope if slope != 0 else 0.0
+            newlevel = min(max(ylevel - step, dmin), dmax)
+            crossings = self.__move(crossings, ylevel, newlevel)
+            ylevel = newlevel
+        self.__crossings[level] = (ylevel, crossings)
+        return ylevel, crossings
+
+    def __move(self, crossings, old, new, changed=()):
+        """
+        Updates the set of segments crossing the level old to those crossing the level new. Only the segments next
+        to the bins with a density between the two levels, and next to the changed bins, can be different.
+        """
+        bins = np.concatenate((self.__sorted.between(min(old, new), max(old, new)), changed)).astype(int)
+        segments = np.unique(np.concatenate((bins - 1, bins)))
+        segments = segments[(segments >= 0) & (segments < len(self.x) - 1)]
+        above = self.__density[segments] >= new
+        cross = above != (self.__density[segments + 1] >= new)
+        crossings.difference_update(segments[~cross].tolist())
+        crossings.update(segments[cross].tolist())
+        return crossings
+
+    def __segments(self, crossings):
+        segments = np.sort(np.fromiter(crossings, dtype=int, count=len(crossings)))
+        return (segments, self.x[segments], self.x[segments + 1],
+                self.__density[segments], self.__density[segments + 1])
+
+    def __mass_above(self, ylevel, crossings):
+        """
+        The entries above the level and the derivative to the level, see _mass_above: the bins above it count
+        with their entries, the crossing segments add their correction
+        """
+        segments, x0, x1, y0, y1 = self.__segments(crossings)
+        lo, hi = np.minimum(y0, y1), np.maximum(y0, y1)
+        dx = x1 - x0
+        frac = (hi - ylevel) / (hi - lo)
+        mass = self.__sorted.mass_above(ylevel) + (0.5 * dx * (frac * (hi + ylevel) - hi)).sum()
+        slope = -(ylevel * dx / (hi - lo)).sum()
+        return mass, slope
+
+    def __intervals(self, ylevel, crossings):
+        """The intervals above the level, see _level_crossings, closed by the outer bin edges"""
+        segments, x0, x1, y0, y1 = self.__segments(crossings)
+        edges = x0 + (ylevel - y0) * (x1 - x0) / (y1 - y0)
+        if self.__density[0] >= ylevel:
+            edges = np.concatenate(([self.edges[0]], edges))
+        if self.__density[-1] >= ylevel:
+            edges = np.concatenate((edges, [self.edges[-1]]))
+        return edges.reshape(-1, 2)
+
+
+class _sortedBins(object):
+    """
+    The bins of a histogram sorted by decreasing density, in blocks of about sqrt(n) bins which each know their
+    number of entries. Moving a bin, finding the level above which the bins hold a number of entries, and the entries
+    above a level all cost of the order of sqrt(n). The density and counts arrays of the histogram are shared,
+    a bin has to be removed before its density changes and inserted again afterwards.
+    """
+
+    def __init__(self, density, counts):
+        self.density = density
+        self.counts = counts
+        self.blocksize = max(16, int(np.sqrt(len(density))))
+        order = np.argsort(-density, kind='mergesort')
+        # the bins of every block by block id, and the block ids in order of decreasing density
+        self.__bins = [order[i:i + self.blocksize] for i in range(0, len(order), self.blocksize)]
+        self.__ids = range(len(self.__bins))
+        self.__entries = [counts[bins].sum() for bins in self.__bins]
+        self.__block = np.empty(len(density), dtype=int)
+        for bid, bins in enumerate(self.__bins):
+            self.__block[bins] = bid
+        self.__index = None
+
+    def __positions(self):
+        """
+        The lowest density, the entries, their cumulative sum and the cumulative number of bins of the blocks in
+        order, rebuilt after a change
+        """
+        if self.__index is None:
+            bins = [self.__bins[bid] for bid in self.__ids]
+            lows = np.array([self.density[b[-1]] if len(b) else np.inf for b in bins])
+            entries = np.array([self.__entries[bid] for bid in self.__ids])
+            self.__index = (lows, entries, np.cumsum(entries), np.cumsum([len(b) for b in bins]))
+        return self.__index
+
+    def remove(self, changed):
+        for b in changed:
+            bid = self.__block[b]
+            bins = self.__bins[bid]
+            self.__bins[bid] = bins[bins != b]
+            self.__entries[bid] -= self.counts[b]
+            if len(self.__bins[bid]) == 0:
+                self.__ids.remove(bid)
+        self.__index = None
+
+    def insert(self, changed):
+        if len(changed) and not self.__ids:
+            self.__ids.append(len(self.__bins))
+            self.__bins.append(np.zeros(0, dtype=int))
+            self.__entries.append(0.0)
+            self.__index = None
+        # the lowest density of every block in order, kept up to date while inserting
+        lows = self.__positions()[0].copy()
+        for b in changed:
+            d = self.density[b]
+            # the first block whose lowest density is not above d, or the last one
+            p = min(np.searchsorted(-lows, -d, 'left'), len(lows) - 1)
+            bid = self.__ids[p]
+            bins = self.__bins[bid]
+            bins = np.insert(bins, np.searchsorted(-self.density[bins], -d, 'left'), b)
+            self.__entries[bid] += self.counts[b]
+            self.__block[b] = bid
+            if len(bins) > 2 * self.blocksize:
+                half = len(bins) // 2
+                new = len(self.__bins)
+                self.__bins.append(bins[half:])
+                self.__entries.append(self.counts[bins[half:]].sum())
+                self.__block[bins[half:]] = new
+                self.__ids.insert(p + 1, new)
+                lows = np.insert(lows, p + 1, self.density[bins[-1]])
+                bins = bins[:half]
+                self.__entries[bid] = self.counts[bins].sum()
+            self.__bins[bid] = bins
+            lows[p] = self.density[bins[-1]]
+        self.__index = None
+
+    def extremes(self):
+        """The lowest and the highest density"""
+        return self.density[self.__bins[self.__ids[-1]][-1]], self.density[self.__bins[self.__ids[0]][0]]
+
+    def mass_above(self, level):
+        """The entries of the bins with a density of at least level"""
+        lows, entries, cumentries, cumsizes = self.__positions()
+        # the first p blocks lie above the level entirely
+        p = np.searchsorted(-lows, -level, 'right')
+        mass = cumentries[p - 1] if p > 0 else 0.0
+        if p < len(lows):
+            bins = self.__bins[self.__ids[p]]
+            mass += self.counts[bins[:np.searchsorted(-self.density[bins], -level, 'right')]].sum()
+        return mass
+
+    def between(self, lo, hi):
+        """The bins with a density from lo up to hi"""
+        lows = self.__positions()[0]
+        first = np.searchsorted(-lows, -hi, 'left')
+        last = min(np.searchsorted(-lows, -lo, 'right'), len(lows) - 1)
+        parts = [np.zeros(0, dtype=int)]
+        for p in range(first, last + 1):
+            bins = self.__bins[self.__ids[p]]
+            d = self.density[bins]
+            parts.append(bins[(d >= lo) & (d <= hi)])
+        return np.concatenate(parts)
+
+    def __element(self, rank):
+        """The density and the centre of the cumulative entries of the bin at this rank"""
+        lows, entries, cumentries, cumsizes = self.__positions()
+        p = np.searchsorted(cumsizes, rank, 'right')
+        bins = self.__bins[self.__ids[p]]
+        counts = self.counts[bins[:rank - (cumsizes[p] - len(bins)) + 1]]
+        return self.density[bins[len(counts) - 1]], cumentries[p] - entries[p] + counts.sum() - 0.5 * counts[-1]
+
+    def level(self, target):
+        """
+        The density level above which the bins hold target entries, interpolated between the centres of the
+        cumulative entries of the sorted bins as in _sorted_levels
+        """
+        lows, entries, cumentries, cumsizes = self.__positions()
+        p = min(np.searchsorted(cumentries, target, 'left'), len(lows) - 1)
+        bins = self.__bins[self.__ids[p]]
+        counts = self.counts[bins]
+        centres = cumentries[p] - entries[p] + np.cumsum(counts) - 0.5 * counts
+        # the first bin whose centre is not below the target, here or at the start of the next block
+        rank = min(max(cumsizes[p] - len(bins) + np.searchsorted(centres, target), 1), cumsizes[-1] - 1)
+        y0, c0 = self.__element(rank - 1)
+        y1, c1 = self.__element(rank)
+        frac = min(max((target - c0) / (c1 - c0 if c1 > c0 else 1.0), 0.0), 1.0)
+        return y0 + frac * (y1 - y0)
+
+
+class quantileCalcND(object):
+    """
+    The multidimensional companion of quantileCalc: calculates the highest density region of a density grid,
+    such as the bin contents of a TH2D or a function evaluated on a numpy meshgrid. The result is the iso-level
+    of the density and a boolean mask of the cells above it, which together contain the requested fraction of
+    the total mass. The level is found as in quantileCalc(..., method="sorted"), sorting the density once.
+    Every cell is a histogram bin, which fills its full width along each axis, also at the edges of the grid.
+
+    USAGE:
+    -Generate the grid-
+    x = np.linspace(-5, 5, 2000)
+    y = np.linspace(-5, 5, 2000)
+    X, Y = np.meshgrid(x, y, indexing='ij')
+    density = np.exp(-0.5 * (X ** 2 + X * Y + Y ** 2))
+    -calculating the region-
+    qc = quantileCalcND(density, axes=[x, y], levels=[0.682, 0.954])
+    ylevel, mask = qc.getquantilevertical()
+    -or for variable binning, with the bin edges-
+    qc = quantileCalcND(density, edges=[xedges, yedges])
+    -plotting the contours (2D only)-
+    qc.plot(show=True)
+
+    """
+
+    def __init__(self, density, lvl=0.682, levels=None, axes=None, edges=None):
+        """
+        The constructor:
+        - density: a numpy array with the density in each cell of the grid, of any dimension
+        - lvl: the requested confidence interval
+        - levels: a list of requested confidence intervals, replacing lvl
+        - axes: a list with the cell centres along each dimension, used for the cell volumes and for plotting.
+                The cells reach half way to their neighbours and half a cell beyond the outer centres.
+                By default every cell has unit size.
+        - edges: a list with the cell edges along each dimension, one more than the cells, replacing the edges
+                 derived from the axes. The axes default to the centres between the edges.
+        """
+        self.density = np.asarray(density, dtype=float)
+        if edges is not None:
+            edges = [np.asarray(e, dtype=float) for e in edges]
+            if axes is None:
+                axes = [0.5 * (e[1:] + e[:-1]) for e in edges]
+        if axes is None:
+            axes = [np.arange(n, dtype=float) for n in self.density.shape]
+        if len(axes) != self.density.ndim:
+            raise ValueError("Expected one axis per dimension of the density, got " + str(len(axes)))
+        self.axes = [np.asarray(a, dtype=float) for a in axes]
+        if edges is None:
+            edges = [_histogram_edges(a) if len(a) > 1 else np.array([-0.5, 0.5]) for a in self.axes]
+        if [len(e) for e in edges] != [len(a) + 1 for a in self.axes]:
+            raise ValueError("Expected one more edge than cells along each dimension")
+        self.edges = edges
+        self.levels = [lvl] if levels is None else list(levels)
+        self.level = self.levels[0]
+        self.__ylevels = None
+
+    @property
+    def volumes(self):
+        """The volume of each cell, as the outer product of the bin widths along each axis"""
+        volumes = np.ones(())
+        for edges in self.edges:
+            volumes = np.multiply.outer(volumes, np.diff(edges))
+        return volumes
+
+    @property
+    def ylevels(self):
+        """Dictionary of each requested level to its iso-level, in the units of the (unnormalized) density"""
+        if self.__ylevels is None:
+            found = _hpd_levels(self.density.reshape(1, -1), self.volumes.ravel(), self.levels)[0]
+            self.__ylevels = dict(zip(self.levels, found))
+        return self.__ylevels
+
+    @property
+    def ylevel(self):
+        return self.ylevels[self.level]
+
+    @property
+    def mask(self):
+        return self.density >= self.ylevel
+
+    def getquantilevertical(self):
+        return self.ylevel, self.mask
+
+    def getquantiles(self):
+        """
+        Returns a dictionary of each requested level to its (ylevel, mask) pair
+        """
+        return dict((level, (ylevel, self.density >= ylevel)) for level, ylevel in self.ylevels.items())
+
+    def plot(self, ax=None, show=False):
+        """
+        Draws a 2D density with the contours of the requested levels.
+
+        - ax: the matplotlib axes to draw on, by default a new figure is made
+        - show: call plt.show() when done, which blocks outside of notebooks
+
+        Returns the axes
+        """
+        if self.density.ndim != 2:
+            raise ValueError("Only 2D densities can be plotted, this one has " + str(self.density.ndim) + " dimensions")
+        if ax is None:
+            fig, ax = plt.subplots()
+        ax.pcolormesh(self.axes[0], self.axes[1], self.density.T)
+        # contour wants increasing levels, the highest confidence has the lowest level
+        ax.contour(self.axes[0], self.axes[1], self.density.T, levels=sorted(self.ylevels.values()), colors='g')
+        if show:
+            plt.show()
+        return ax
+
+
+def _bin_widths(x):
+    """
+    The width of the bin around each point of a sorted grid, reaching half way to the neighbouring points
+    """
+    edges = np.concatenate(([x[0]], 0.5 * (x[1:] + x[:-1]), [x[-1]]))
+    return np.diff(edges)
+
+
+def _histogram_edges(x):
+    """
+    The edges of histogram bins centred on the points of a sorted grid: half way between the points,
+    and half a bin beyond the first and the last point
+    """
+    if len(x) < 2:
+        raise ValueError("Need at least two bin centres to derive the bin edges")
+    mids = 0.5 * (x[1:] + x[:-1])
+    return np.concatenate(([x[0] - (mids[0] - x[0])], mids, [x[-1] + (x[-1] - mids[-1])]))
+
+
+def _hpd_levels(Y, widths, levels):
+    """
+    The density levels above which the bins contain the requested fractions of the total area, for every row of Y.
+    Each row is sorted once, from high to low, and the levels are interpolated on the cumulative sum of the bin areas.
+    A bin at exactly the level is cut through its centre, so only half of its own area counts as contained.
+    Returns an array of shape (rows, levels).
+    """
+    rows = np.arange(Y.shape[0])[:, np.newaxis]
+    order = np.argsort(Y, axis=1)[:, ::-1]
+    ysorted = Y[rows, order]
+    return _sorted_levels(ysorted, ysorted * widths[order], levels)
+
+
+def _sorted_levels(ysorted, areas, levels):
+    """
+    The level finding of _hpd_levels, for rows which are already sorted from high to low, given the area of each bin
+    """
+    nrows, npts = ysorted.shape
+    rows = np.arange(nrows)[:, np.newaxis]
+    cumul = np.cumsum(areas, axis=1)
+    centres = cumul - 0.5 * areas
+    targets = np.outer(cumul[:, -1], levels)
+    # one searchsorted for all rows, by shifting each row into its own disjoint range
+    offsets = (np.arange(nrows) * (cumul[:, -1].max() + 1.0))[:, np.newaxis]
+    idx = np.searchsorted((centres + offsets).ravel(), (targets + offsets).ravel()).reshape(targets.shape)
+    idx = np.clip(idx - rows * npts, 1, npts - 1)
+    c0, c1 = centres[rows, idx - 1], centres[rows, idx]
+    y0, y1 = ysorted[rows, idx - 1], ysorted[rows, idx]
+    frac = np.clip((targets - c0) / np.where(c1 > c0, c1 - c0, 1.0), 0.0, 1.0)
+    return y0 + frac * (y1 - y0)
+
+
+def _mass_above(x, Y, ylevels, widths=None):
+    """
+    The area above the level under the linear interpolation of each row of Y, and its derivative to the level.
+    The points above the level count with the area of their bin, only the segments crossing the level need a
+    correction, so the cost is a few passes over Y. The bins reach half way to the neighbouring points, unless
+    their widths are given.
+    """
+    dx = np.diff(x)
+    above = Y >= ylevels[:, np.newaxis]
+    mass = (Y * above).dot(_bin_widths(x) if widths is None else widths)
+    rows, cols = np.nonzero(above[:, 1:] != above[:, :-1])
+    lvl = ylevels[rows]
+    y0, y1 = Y[rows, cols], Y[rows, cols + 1]
+    lo, hi = np.minimum(y0, y1), np.maximum(y0, y1)
+    frac = (hi - lvl) / (hi - lo)
+    mass += np.bincount(rows, 0.5 * dx[cols] * (frac * (hi + lvl) - hi), minlength=len(Y))
+    slope = -np.bincount(rows, lvl * dx[cols] / (hi - lo), minlength=len(Y))
+    return mass, slope
+
+
+def _polish_levels(x, Y, ylevels, level, nsteps=2, widths=None):
+    """
+    Newton steps on the area above the level, removing the binning error of the sorted estimate.
+    The rows of Y must be normalized to a unit area, see _mass_above for the widths.
+    """
+    ymin, ymax = Y.min(axis=-1), Y.max(axis=-1)
+    for i in range(nsteps):
+        mass, slope = _mass_above(x, Y, ylevels, widths)
+        step = np.where(slope != 0, (mass - level) / np.where(slope != 0, slope, 1.0), 0.0)
+        ylevels = np.clip(ylevels - step, ymin, ymax)
+    return ylevels
+
+
+def _level_crossings(x, Y, ylevels, bounds=None):
+    """
+    Returns, for every row of Y, the intervals where it lies above its level, as an array of (begin, end) pairs.
+    The edges are linearly interpolated between the grid points, the bounds (by default the grid boundaries)
+    close open intervals.
+    """
+    xlow, xhigh = (x[0], x[-1]) if bounds is None else bounds
+    npts = Y.shape[1]
+    above = Y >= ylevels[:, np.newaxis]
+    rows, cols = np.nonzero(above[:, 1:] != above[:, :-1])
+    x0, x1 = x[cols], x[cols + 1]
+    y0, y1 = Y[rows, cols], Y[rows, cols + 1]
+    edges = x0 + (ylevels[rows] - y0) * (x1 - x0) / (y1 - y0)
+    first, last = np.flatnonzero(above[:, 0]), np.flatnonzero(above[:, -1])
+    rows = np.concatenate((first, rows, last))
+    keys = np.concatenate((np.full(len(first), -1), cols, np.full(len(last), npts)))
+    edges = np.concatenate((np.full(len(first), xlow), edges, np.full(len(last), xhigh)))
+    order = np.lexsort((keys, rows))
+    counts = np.bincount(rows, minlength=len(Y))
+    return [e.reshape(-1, 2) for e in np.split(edges[order], np.cumsum(counts)[:-1])]
+
+
+def _batch_quantiles(x, Y, levels):
+    """
+    Normalizes every row of Y and computes the vertical quantiles for all levels with the sorted method
+    """
+    widths = _bin_widths(x)
+    Y = Y / (Y * widths).sum(axis=1)[:, np.newaxis]
+    ylevels = _hpd_levels(Y, widths, levels)
+    intervals = [[] for row in Y]
+    for j, level in enumerate(levels):
+        ylevels[:, j] = _polish_levels(x, Y, ylevels[:, j], level)
+        for curve, edges in zip(intervals, _level_crossings(x, Y, ylevels[:, j])):
+            curve.append(edges)
+    return ylevels, intervals
+
+
+def _batch_worker(args):
+    """
+    Entry point for the worker processes of quantileCalc.batch, which must be picklable
+    """
+    return _batch_quantiles(*args)
 
 
 def getquantileleft(histo, level=0.67):
@@ -176,17 +925,62 @@ def getquantileleft(histo, level=0.67):
     Gets the quantile levels from a ROOT histogram. This function calculates the integral of the normalized histogram
     and returns the bin center of the bin where the level is first reached. The computation starts from left to right.
     """
-    val = 0
-    integralarr = histo.GetIntegral()
+    integralarr = roothistos.th1_integral(histo)
     nbins = histo.GetNbinsX()
-    thebin = 0
-    for i in range(nbins):
-        if integralarr[i] > level:
-            thebin = i
-            break
-
-    val = histo.GetXaxis().GetBinCenter(thebin)
-    return val
+    # the first bin whose cumulative integral exceeds the level, 0 if there is none
+    thebin = np.searchsorted(integralarr[:nbins], level, side='right')
+    if thebin == nbins:
+        thebin = 0
+    return histo.GetXaxis().GetBinCenter(int(thebin))
+
+
+def getquantileright(histo, level=0.67):
+    """
+    Gets the quantile levels from a ROOT histogram. This function calculates the integral of the normalized histogram
+    and returns the bin center of the bin where the level is first reached. The computation starts from right to left.
+    """
+    integralarr = roothistos.th1_integral(histo)
+    # the integral from the right down to bin b is 1 - integralarr[b - 1]
+    thebin = np.searchsorted(integralarr, 1.0 - level, side='left')
+    return histo.GetXaxis().GetBinCenter(int(max(thebin, 1)))
+
+
+def getquantilecentral(histo, level=0.682):
+    """
+    Gets the central interval from a ROOT histogram, leaving (1 - level) / 2 of the integral on either side.
+    Returns the bin centers of the left and the right edge.
+    """
+    return getquantileleft(histo, 0.5 * (1.0 - level)), getquantileright(histo, 0.5 * (1.0 - level))
+
+
+def getquantilevertical(histo, level=0.682):
+    """
+    Gets the highest density region from a ROOT TH1 or TH2, the bins of highest density which together contain
+    the requested fraction of the integral. The level is found from the sorted bin densities as in
+    quantileCalc(..., method="sorted"), directly on the histogram buffer.
+    The density is the bin content per unit bin width (per unit bin area for a TH2).
+
+    Returns the density level and, for a TH1, an array of (begin, end) bin edges of the intervals above it,
+    for a TH2, a boolean mask indexed [xbin, ybin] of the bins above it.
+    """
+    if histo.GetDimension() == 1:
+        contents = roothistos.th1_contents(histo).astype(float)
+        edges = roothistos.axis_edges(histo.GetXaxis())
+        widths = np.diff(edges)
+        density = contents / widths
+        ylevel = _hpd_levels(density[np.newaxis, :], widths, [level])[0, 0]
+        above = np.concatenate(([False], density >= ylevel, [False]))
+        change = np.flatnonzero(above[1:] != above[:-1])
+        return ylevel, edges[change].reshape(-1, 2)
+    if histo.GetDimension() == 2:
+        contents = roothistos.th2_contents(histo).astype(float)
+        widths = np.multiply.outer(np.diff(roothistos.axis_edges(histo.GetXaxis())),
+                                   np.diff(roothistos.axis_edges(histo.GetYaxis())))
+        density = contents / widths
+        ylevel = _hpd_levels(density.reshape(1, -1), widths.ravel(), [level])[0, 0]
+        return ylevel, density >= ylevel
+    raise ValueError("Only TH1 and TH2 histograms are supported, this one has "
+                     + str(histo.GetDimension()) + " dimensions")
 
 
 def test_verticalquantile():
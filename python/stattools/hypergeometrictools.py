@@ -15,11 +15,49 @@
 #   limitations under the License.
 #
 ##############################################################################
+import collections
 import numpy
-import scipy.stats
+import scipy.special
+import scipy.sparse
 import math
 import matplotlib.pyplot as plt
 import numpy as np
+import roothistos
+
+# The vectorized functions only look at k values within this many standard deviations (plus this many values)
+# around the mean, the probabilities outside of that window are below ~1e-30 of the peak
+WINDOW_NSIGMA = 12
+# The same for the distributions of inv_hypergeometric_sumlargeprobabilities, which may have exponential tails
+INV_WINDOW_NSIGMA = 70
+# The largest number of probabilities the vectorized functions hold in memory at once
+BLOCK_SIZE = 2 ** 22
+# The difference in log-probability below which two probabilities count as equal
+LOG_TIE_TOL = 1e-10
+# Distributions with windows wider than this are not summed term by term, their sums of probabilities are
+# integrated over TAIL_PANELS Simpson panels instead, which bounds the runtime and memory for huge populations
+TAIL_WIDTH = 2 ** 18
+TAIL_PANELS = 1024
+# Over such wide windows the sums of probabilities smaller than p(k) stop where they fall below exp(-TAIL_CUT) p(k)
+TAIL_CUT = 40
+# hypergeometric_sumlargeprobabilities_array tabulates distributions shared by at least this many elements
+TABLE_MIN_COUNT = 16
+# hypergeometric_quantize_2d_correlation_histo works on blocks of rows of about this many bins, each with its own
+# random numbers: small enough that a pool of processes gets many blocks to share, whatever its size
+QUANTIZE_BLOCK_BINS = 2 ** 12
+# The multiple-testing corrections of adjust_pvalues
+CORRECTIONS = ['bh', 'bonferroni']
+
+
+def check_random_state(random_state=None):
+    """
+    Returns a numpy.random.RandomState for random_state, which may be None (the global numpy.random state),
+    an integer seed or a RandomState, which is returned as it is
+    """
+    if random_state is None:
+        return numpy.random.mtrand._rand
+    if isinstance(random_state, numpy.random.RandomState):
+        return random_state
+    return numpy.random.RandomState(random_state)
 
 
 def hypergeometric_var_min(N, K, n):
@@ -32,85 +70,853 @@ def hypergeometric_var_max(N, K, n):
     return long(n if n < K else K)
 
 
-def hypergeometric_sumlargeprobabilities(N, K, n, k):
+def hypergeometric_sumlargeprobabilities(N, K, n, k, random_state=None, midp=False, cache=None):
     """
     Determines how unlikely it is that given a total sample of N elements with K elements of a specific type,
     a random subsample of n elements contains k elements of the specific type.
     Returns a value between 0 and 1, where 1 indicates very unlikely and 0 very likely.
     If the subsample is truly drawn in a random way from the total sample, then this
     hypergeometric_sumlargeprobabilities has a uniform distribution.
+    The probability of k itself is counted with a uniform random weight, drawn from random_state
+    (see check_random_state). With midp=True it is counted with weight one half, the deterministic mid-p value.
+    With a hypergeometricCache as cache, the distribution of (N, K, n) is looked up instead of recomputed.
     """
-    if n == 0 or K == 0:
-        return numpy.random.uniform()
-    kmin = hypergeometric_var_min(N, K, n)
-    kmax = hypergeometric_var_max(N, K, n)
-    sampleprobability = scipy.stats.hypergeom.pmf(k, N, K, n)
-    result = sampleprobability * numpy.random.uniform()
-    prob = sampleprobability
-    if (2 * K == N):
-        # This part is in stead of the else part because for symmetric distributions (where N = 2K)
-        # the '<=' and the '<' below do not sufficiently distinguish the symmetric probabilities
-        # left and right of the central value
-        for i in range(k, n - k - 1, +1):
-            prob = prob * float((K - i) * (n - i)) / float((i + 1) * (N - K - n + i + 1))
-            result = result + prob
-        prob = sampleprobability
-        for i in range(k, n - k, -1):
-            prob = prob * float((i) * (N - K - n + i)) / float((n - i + 1) * (K - i + 1))
-            result = result + prob
-    else:
-        for i in range(k, kmax, +1):
-            prob = prob * float((K - i) * (n - i)) / float((i + 1) * (N - K - n + i + 1))
-            if prob <= sampleprobability:
-                break
-            result = result + prob
-        prob = sampleprobability
-        for i in range(k, kmin, -1):
-            prob = prob * float((i) * (N - K - n + i)) / float((n - i + 1) * (K - i + 1))
-            if prob < sampleprobability:
-                break
-            result = result + prob
-    return result
+    if cache is not None:
+        return cache.sumlargeprobabilities(N, K, n, k, random_state, midp)
+    u = 0.5 if midp else check_random_state(random_state).uniform()
+    return _hypergeometric_sumlargeprobabilities_scalar(N, K, n, k, u)
 
 
-def inv_hypergeometric_sumlargeprobabilities(m, M, n, N):
+def inv_hypergeometric_sumlargeprobabilities(m, M, n, N, random_state=None, midp=False):
     """
     Determines how unlikely it is that after a first sample of N elements with n elements of a specific type,
     a second sample of M elements contains m elements of the specific type.
     Returns a value between 0 and 1, where 1 indicates very unlikely and 0 very likely.
     If the second sample is truly drawn from the same collection as the first sample, then this
     inv_hypergeometric_sumlargeprobabilities has a uniform distribution.
+    The random weight of the probability of m and midp work as in hypergeometric_sumlargeprobabilities.
+    """
+    u = 0.5 if midp else check_random_state(random_state).uniform()
+    return float(_inv_hypergeometric_sumlargeprobabilities_vectorized([m], [M], [n], [N], [u])[0])
+
+
+def _window(mean, var, smin, smax, nsigma=WINDOW_NSIGMA, reach=0):
+    """
+    The range of values of each distribution which holds all but a negligible part of the probability:
+    the support [smin, smax], cut to the window of nsigma standard deviations (plus nsigma) around the mean,
+    widened by reach on both sides
+    """
+    half = np.ceil(nsigma * np.sqrt(var) + reach) + nsigma
+    lo = np.maximum(smin, np.floor(mean - half).astype(np.int64))
+    hi = np.minimum(smax, np.ceil(mean + half).astype(np.int64))
+    return lo, hi
+
+
+def _hypergeometric_moments(N, K, n):
+    """
+    The mean, variance, support and mode of the hypergeometric distributions of arrays of N, K and n
+    """
+    Nf, Kf, nf = [np.asarray(a, dtype=float) for a in (N, K, n)]
+    Nf1 = np.maximum(Nf, 1)
+    mean = nf * Kf / Nf1
+    var = nf * Kf * (Nf - Kf) * (Nf - nf) / (Nf1 * Nf1 * np.maximum(Nf - 1, 1))
+    smin = np.maximum(n - N + K, 0)
+    smax = np.minimum(n, K)
+    mode = np.clip(np.floor((nf + 1) * (Kf + 1) / (Nf + 2)).astype(np.int64), smin, smax)
+    return mean, var, smin, smax, mode
+
+
+def _hypergeometric_window(N, K, n):
+    """
+    The range of k values of each hypergeometric distribution which holds all but a negligible part of
+    the probability, see _window
+    """
+    return _window(*_hypergeometric_moments(N, K, n)[:4])
+
+
+def _inv_hypergeometric_moments(M, n, N):
+    """
+    The mean, variance, support and mode of the distributions of m in inv_hypergeometric_sumlargeprobabilities,
+    which are beta-binomial distributions of M draws with parameters n + 1 and N - n + 1
+    """
+    Mf, nf, Nf = [np.asarray(a, dtype=float) for a in (M, n, N)]
+    alpha, beta = nf + 1, Nf - nf + 1
+    mean = Mf * alpha / (alpha + beta)
+    var = Mf * alpha * beta * (alpha + beta + Mf) / ((alpha + beta) ** 2 * (alpha + beta + 1))
+    smin = np.zeros_like(np.asarray(M))
+    smax = np.asarray(M)
+    mode = np.clip(np.floor(nf * (Mf + 1) / np.maximum(Nf, 1)).astype(np.int64), smin, smax)
+    return mean, var, smin, smax, mode
+
+
+def _window_logpmf(lo, hi, logratio):
+    """
+    The values, log-probabilities and probabilities over the windows [lo, hi] of a block of cells,
+    padded with -inf (zero probability) up to the widest window. See _sumlargeprobabilities_block.
+    """
+    ncells = len(lo)
+    cells = np.arange(ncells)[:, np.newaxis]
+    i = lo[:, np.newaxis] + np.arange((hi - lo).max() + 1)
+    valid = i <= hi[:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        steps = np.where(valid[:, 1:], logratio(i[:, :-1], cells), 0.0)
+    logp = np.concatenate((np.zeros((ncells, 1)), np.cumsum(steps, axis=1)), axis=1)
+    logp = np.where(valid, logp, -np.inf)
+    logp -= logp.max(axis=1)[:, np.newaxis]
+    p = np.exp(logp)
+    p /= p.sum(axis=1)[:, np.newaxis]
+    return i, logp, p
+
+
+def _largeprobabilities_table(logp, p):
+    """
+    The sum of the probabilities larger than p(k), for every k of one window at once, counting equal
+    probabilities left of k only. The window is sorted by probability, equal probabilities form one group
+    in which the values are ordered from right to left, so everything after k in this order counts as larger.
+    """
+    order = np.argsort(logp, kind='mergesort')
+    group = np.concatenate(([0], np.cumsum(np.diff(logp[order]) > LOG_TIE_TOL)))
+    order = order[np.lexsort((-order, group))]
+    larger = np.empty(len(p))
+    larger[order] = p.sum() - np.cumsum(p[order])
+    return np.maximum(larger, 0.0)
+
+
+def _hypergeometric_logratio(N, K, n):
+    """
+    log(p(i + 1) / p(i)) of the hypergeometric distributions of arrays of N, K and n, as used by _window_logpmf
+    """
+    Nf, Kf, nf = [np.asarray(a, dtype=float) for a in (N, K, n)]
+
+    def logratio(i, cells):
+        return (np.log(Kf[cells] - i) + np.log(nf[cells] - i)
+                - np.log(i + 1.0) - np.log(Nf[cells] - Kf[cells] - nf[cells] + i + 1))
+    return logratio
+
+
+def _lgammadiff(x, d):
+    """
+    lgamma(x + d) - lgamma(x), also accurate for huge x where both terms are large: with Stirling's series the
+    rounding error is of the order of the difference instead of that of lgamma(x)
+    """
+    y = x + d
+    stirling = np.minimum(x, y) >= 1e3
+    xs = np.where(stirling, x, 1e3)
+    ds = np.where(stirling, d, 0.0)
+    ys = xs + ds
+
+    def correction(z):
+        return 1.0 / (12 * z) - 1.0 / (360 * z ** 3)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        direct = scipy.special.gammaln(y) - scipy.special.gammaln(x)
+    series = (xs - 0.5) * np.log1p(ds / xs) + ds * np.log(ys) - ds + correction(ys) - correction(xs)
+    return np.where(stirling, series, direct)
+
+
+def _hypergeometric_logpmf(N, K, n, ref):
+    """
+    log(p(i) / p(ref)) of the hypergeometric distributions of arrays of N, K and n, with a reference value ref
+    per cell, continued smoothly to non-integer i as used by _sumlargeprobabilities_tails
+    """
+    Nf, Kf, nf, rf = [np.asarray(a, dtype=float) for a in (N, K, n, ref)]
+
+    def logpmf(i, cells):
+        r, d = rf[cells], i - rf[cells]
+        return -(_lgammadiff(r + 1, d) + _lgammadiff(Kf[cells] - r + 1, -d)
+                 + _lgammadiff(nf[cells] - r + 1, -d) + _lgammadiff(Nf[cells] - Kf[cells] - nf[cells] + r + 1, d))
+    return logpmf
+
+
+def _inv_hypergeometric_logratio(M, n, N):
+    """
+    log(p(i + 1) / p(i)) of the distributions of m in inv_hypergeometric_sumlargeprobabilities
+    """
+    Mf, nf, Nf = [np.asarray(a, dtype=float) for a in (M, n, N)]
+
+    def logratio(i, cells):
+        return (np.log(nf[cells] + i + 1) + np.log(Mf[cells] - i)
+                - np.log(i + 1.0) - np.log(Nf[cells] + Mf[cells] - nf[cells] - i))
+    return logratio
+
+
+def _inv_hypergeometric_logpmf(M, n, N, ref):
+    """
+    log(p(i) / p(ref)) of the distributions of m in inv_hypergeometric_sumlargeprobabilities,
+    see _hypergeometric_logpmf
+    """
+    Mf, nf, Nf, rf = [np.asarray(a, dtype=float) for a in (M, n, N, ref)]
+
+    def logpmf(i, cells):
+        r, d = rf[cells], i - rf[cells]
+        return (_lgammadiff(r + nf[cells] + 1, d) + _lgammadiff(Mf[cells] - r + Nf[cells] - nf[cells] + 1, -d)
+                - _lgammadiff(r + 1, d) - _lgammadiff(Mf[cells] - r + 1, -d))
+    return logpmf
+
+
+def _sumlargeprobabilities_block(lo, hi, k, u, logratio, lower=False):
+    """
+    The sum of larger probabilities for a block of cells, each with its own window [lo, hi] of a unimodal
+    distribution. logratio(i, cells) gives log(p(i + 1) / p(i)) for the cells selected by the index array.
+    The log-probabilities over the windows are built with a cumulative sum of these ratios, which keeps their
+    differences accurate also for huge populations, and normalized over the window.
+    Following hypergeometric_sumlargeprobabilities, a probability equal to p(k) counts as larger left of k only.
+    With lower=True the result is the complement, the sum of the smaller probabilities plus (1 - u) p(k), summed
+    directly so that it keeps its precision when it is tiny. The windows must then reach beyond k and its mirror
+    point on the other side of the mode.
+    """
+    cells = np.arange(len(lo))[:, np.newaxis]
+    i, logp, p = _window_logpmf(lo, hi, logratio)
+    # an observed k outside of the window has a negligible probability, every value in the window is larger
+    inside = (k >= lo) & (k <= hi)
+    jk = np.where(inside, k - lo, 0)
+    logpk = np.where(inside, logp[cells[:, 0], jk], -np.inf)[:, np.newaxis]
+    pk = np.where(inside, p[cells[:, 0], jk], 0.0)
+    with np.errstate(invalid='ignore'):
+        diff = logp - logpk
+        larger = (diff > LOG_TIE_TOL) | ((np.abs(diff) <= LOG_TIE_TOL) & (i < k[:, np.newaxis]))
+    if lower:
+        smaller = ~larger & (i != k[:, np.newaxis])
+        return np.where(inside, np.minimum((p * smaller).sum(axis=1) + (1 - u) * pk, 1.0), 0.0)
+    return np.minimum((p * larger).sum(axis=1) + u * pk, 1.0)
+
+
+def _sumlargeprobabilities_blocks(lo, hi, k, u, logratio, lower=False):
+    """
+    Runs _sumlargeprobabilities_block over blocks of cells of similar window width,
+    keeping at most BLOCK_SIZE probabilities in memory
+    """
+    result = numpy.empty(len(k))
+    order = np.argsort(hi - lo, kind='mergesort')
+    width = (hi - lo + 1)[order]
+    start = 0
+    while start < len(order):
+        end = min(len(order), start + max(1, BLOCK_SIZE // width[start]))
+        while end - start > 1 and (end - start) * width[end - 1] > BLOCK_SIZE:
+            end = start + max(1, BLOCK_SIZE // width[end - 1])
+        sel = order[start:end]
+        result[sel] = _sumlargeprobabilities_block(lo[sel], hi[sel], k[sel], u[sel],
+                                                   lambda i, cells: logratio(i, sel[cells]), lower)
+        start = end
+    return result
+
+
+def _bisect(lo, hi, pred):
+    """
+    The first integer i in [lo, hi] for which pred(i) holds, for arrays of intervals and a pred that is
+    monotone (False, then True) on them, or hi + 1 where it nowhere holds
+    """
+    lo, hi = lo.copy(), hi + 1
+    active = lo < hi
+    while active.any():
+        mid = (lo + hi) // 2
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ok = pred(mid)
+        hi = np.where(active & ok, mid, hi)
+        lo = np.where(active & ~ok, mid + 1, lo)
+        active = lo < hi
+    return lo
+
+
+def _integrate_pmf(x0, x1, logpmf):
+    """
+    sum_i exp(logpmf(i)) for i = x0 .. x1, approximated by the integral from x0 - 1/2 to x1 + 1/2
+    with Simpson's rule over TAIL_PANELS panels
+    """
+    t = np.linspace(0.0, 1.0, TAIL_PANELS + 1)[:, np.newaxis]
+    x = (x0 - 0.5) + t * (x1 - x0 + 1.0)
+    weights = np.ones(TAIL_PANELS + 1)
+    weights[1:-1:2] = 4
+    weights[2:-1:2] = 2
+    f = np.exp(logpmf(x))
+    return weights.dot(f) * (x1 - x0 + 1.0) / (3.0 * TAIL_PANELS)
+
+
+def _integrate_range(x0, x1, logpmf):
+    """_integrate_pmf, zero for the empty ranges where x1 < x0"""
+    return np.where(x1 >= x0, _integrate_pmf(x0, np.maximum(x1, x0), logpmf), 0.0)
+
+
+def _sumlargeprobabilities_tails(lo, hi, mode, k, u, logpmf, lower=False, core=None):
+    """
+    The sum of larger probabilities for cells whose distributions are too wide to sum term by term.
+    logpmf(i) gives the log-probabilities of the cells relative to that of their mode, also between integer i.
+    The values more probable than k form an interval around the mode, from k to a mirror point on the other
+    side of the mode which is found by bisection on the exact logpmf. Its probability and that of the whole window,
+    for the normalization, are integrated with Simpson's rule. For these wide distributions the relative error of
+    replacing the sums by integrals is of order 1 / variance, the cost does not depend on the width.
+    The tie rule is that of _sumlargeprobabilities_block, with a tolerance that grows with the distance to the mode
+    like the rounding errors of logpmf.
+    With lower=True the result is the complement, see _sumlargeprobabilities_block: the smaller probabilities,
+    beyond k and beyond the mirror point, are integrated directly, each range cut where its probabilities fall
+    below exp(-TAIL_CUT) p(k). The normalization is then integrated over core, the window without the widening.
+    """
+    inside = (k >= lo) & (k <= hi)
+    k = np.clip(k, lo, hi)
+    logpk = logpmf(k)
+    tol = LOG_TIE_TOL * (1 + np.abs(k - mode))
+    left = k <= mode
+    # left of the mode the larger values are k + 1 .. b, right of it a .. k - 1
+    b = _bisect(np.maximum(mode, k), hi, lambda i: logpmf(i) <= logpk + tol) - 1
+    a = _bisect(lo, mode, lambda i: logpmf(i) >= logpk - tol)
+    x0 = np.where(left, k + 1, a)
+    x1 = np.where(left, b, k - 1)
+    # a value left of k with the same probability is larger as well
+    logpprev = logpmf(np.maximum(k - 1, lo))
+    tie = np.where(left & (k > lo) & (logpprev >= logpk - tol), np.exp(logpprev), 0.0)
+    nlo, nhi = (lo, hi) if core is None else core
+    norm = _integrate_pmf(nlo, nhi, logpmf)
+    if lower:
+        cut = logpk - TAIL_CUT
+        # left of the mode the smaller values are .. k - 1 and b + 1 .., right of it .. a - 1 and k + 1 ..
+        # at the mode there are no larger values, b = k - 1, and the right range starts after k itself
+        right = np.where(left, np.maximum(b, k), k) + 1
+        start = _bisect(lo, np.where(left, k, a) - 1, lambda i: logpmf(i) >= cut)
+        stop = _bisect(right, hi, lambda i: logpmf(i) < cut) - 1
+        mass = (_integrate_range(start, np.where(left, k, a) - 1, logpmf)
+                + _integrate_range(right, stop, logpmf) - tie)
+        result = np.minimum((np.maximum(mass, 0.0) + (1 - u) * np.exp(logpk)) / norm, 1.0)
+        return np.where(inside, result, 0.0)
+    mass = _integrate_range(x0, x1, logpmf) + tie
+    result = np.minimum((mass + u * np.exp(logpk)) / norm, 1.0)
+    return np.where(inside, result, 1.0)
+
+
+def _sumlargeprobabilities(lo, hi, mode, k, u, logratio, logpmf, lower=False, core=None):
+    """
+    The sum of larger probabilities for 1-D arrays of cells, given the windows and modes of their distributions
+    and their logratio and logpmf functions. The probabilities of windows up to TAIL_WIDTH values wide are summed
+    in blocks, see _sumlargeprobabilities_blocks, those of wider windows are integrated,
+    see _sumlargeprobabilities_tails. For lower and core see there.
+    """
+    k = np.asarray(k, dtype=np.int64)
+    u = np.asarray(u, dtype=float)
+    result = numpy.empty(len(k))
+    wide = hi - lo + 1 > TAIL_WIDTH
+    sel = np.flatnonzero(~wide)
+    if len(sel):
+        result[sel] = _sumlargeprobabilities_blocks(lo[sel], hi[sel], k[sel], u[sel],
+                                                    lambda i, cells: logratio(i, sel[cells]), lower)
+    wide = np.flatnonzero(wide)
+    step = max(1, BLOCK_SIZE // (TAIL_PANELS + 1))
+    for start in range(0, len(wide), step):
+        sel = wide[start:start + step]
+        result[sel] = _sumlargeprobabilities_tails(lo[sel], hi[sel], mode[sel], k[sel], u[sel],
+                                                   lambda i: logpmf(i, sel), lower,
+                                                   None if core is None else (core[0][sel], core[1][sel]))
+    return result
+
+
+def _hypergeometric_sumlargeprobabilities_vectorized(N, K, n, k, u, lower=False):
+    """
+    The vectorized engine of hypergeometric_sumlargeprobabilities, for 1-D arrays of cells,
+    each with its own N, K, n, k and uniform random number u.
+    With lower=True it returns the p-values, one minus the result, computed directly (see _sumlargeprobabilities_block)
+    """
+    N, K, n = [np.asarray(a, dtype=np.int64) for a in (N, K, n)]
+    mean, var, smin, smax, mode = _hypergeometric_moments(N, K, n)
+    lo, hi = _window(mean, var, smin, smax)
+    core = None
+    if lower:
+        # the windows have to reach beyond k and its mirror point, which for these log-concave distributions
+        # lies less than twice as far from the mean on the other side
+        core = (lo, hi)
+        lo, hi = _window(mean, var, smin, smax, reach=2 * np.abs(np.asarray(k) - mean))
+    return _sumlargeprobabilities(lo, hi, mode, k, u, _hypergeometric_logratio(N, K, n),
+                                  _hypergeometric_logpmf(N, K, n, mode), lower, core)
+
+
+def _hypergeometric_sumlargeprobabilities_scalar(N, K, n, k, u):
+    """
+    _hypergeometric_sumlargeprobabilities_vectorized for a single cell, with the same window and the same sums,
+    without the bookkeeping of the blocks. Windows wider than TAIL_WIDTH go to the vectorized engine.
+    """
+    Nf, Kf, nf = float(N), float(K), float(n)
+    Nf1 = max(Nf, 1.0)
+    mean = nf * Kf / Nf1
+    var = nf * Kf * (Nf - Kf) * (Nf - nf) / (Nf1 * Nf1 * max(Nf - 1, 1.0))
+    half = math.ceil(WINDOW_NSIGMA * math.sqrt(var)) + WINDOW_NSIGMA
+    lo = max(n - N + K, 0, int(math.floor(mean - half)))
+    hi = min(n, K, int(math.ceil(mean + half)))
+    if hi - lo + 1 > TAIL_WIDTH:
+        return float(_hypergeometric_sumlargeprobabilities_vectorized([N], [K], [n], [k], [u])[0])
+    if not lo <= k <= hi:
+        # a negligible probability, all others are larger
+        return 1.0
+    i = np.arange(lo, hi + 1, dtype=float)
+    with np.errstate(divide='ignore'):
+        steps = np.log(Kf - i[:-1]) + np.log(nf - i[:-1]) - np.log(i[:-1] + 1.0) - np.log(Nf - Kf - nf + i[:-1] + 1)
+    logp = np.concatenate(([0.0], np.cumsum(steps)))
+    logp -= logp.max()
+    p = np.exp(logp)
+    p /= p.sum()
+    j = int(k) - lo
+    diff = logp - logp[j]
+    larger = (diff > LOG_TIE_TOL) | ((np.abs(diff) <= LOG_TIE_TOL) & (i < k))
+    return min(float(p[larger].sum() + u * p[j]), 1.0)
+
+
+def _inv_hypergeometric_sumlargeprobabilities_vectorized(m, M, n, N, u):
+    """
+    The vectorized engine of inv_hypergeometric_sumlargeprobabilities, see
+    _hypergeometric_sumlargeprobabilities_vectorized
     """
-    sampleprobability = scipy.stats.hypergeom.pmf(m, N + M, n + m, M)
-    result = sampleprobability * numpy.random.uniform()
-    prob = sampleprobability
-    if (2 * n == N):
-        # This part is in stead of the else part because for symmetric distributions (where N = 2n)
-        # the '<=' and the '<' below do not sufficiently distinguish the symmetric probabilities
-        # left and right of the central value
-        for i in range(m, M - m - 1, +1):
-            prob = prob * float((n + i + 1) * (M - i)) / float((i + 1) * (N + M - n - i))
-            result = result + prob
-        prob = sampleprobability
-        for i in range(m, M - m, -1):
-            prob = prob * float((i) * (N + M - n - i + 1)) / float((n + i) * (M - i + 1))
-            result = result + prob
+    M, n, N = [np.asarray(a, dtype=np.int64) for a in (M, n, N)]
+    mean, var, smin, smax, mode = _inv_hypergeometric_moments(M, n, N)
+    lo, hi = _window(mean, var, smin, smax, INV_WINDOW_NSIGMA)
+    return _sumlargeprobabilities(lo, hi, mode, m, u,
+                                  _inv_hypergeometric_logratio(M, n, N), _inv_hypergeometric_logpmf(M, n, N, mode))
+
+
+def _entry_nbytes(entry):
+    return sum(a.nbytes for a in entry if isinstance(a, np.ndarray))
+
+
+def _inverse_hypergeometric_cdf(M, N, n):
+    """
+    The cumulative distribution of m = 0 .. M for inv_hypergeometric_random, built from the ratios
+    p(m + 1) / p(m) in log space so that it does not underflow for large M
+    """
+    m = np.arange(M, dtype=float)
+    with np.errstate(divide='ignore'):
+        steps = (np.log(n + m + 1) + np.log(M - m) - np.log(m + 1) - np.log(N + M - n - m))
+    logp = np.concatenate(([0.0], np.cumsum(steps)))
+    p = np.exp(logp - logp.max())
+    cdf = np.cumsum(p)
+    cdf /= cdf[-1]
+    return cdf
+
+
+class hypergeometricCache(object):
+    """
+    A least-recently-used cache of hypergeometric distributions, for many queries with the same N, K and n.
+    For each (N, K, n) it holds the probabilities over the relevant range of k and, for every k, the sum of the
+    probabilities larger than p(k). Repeated hypergeometric_sumlargeprobabilities queries are then lookups.
+
+    USAGE:
+    cache = hypergeometricCache(maxbytes=64 * 2 ** 20)
+    p = hypergeometric_sumlargeprobabilities(N, K, n, k, cache=cache)
+    or directly
+    p = cache.sumlargeprobabilities(N, K, n, k)
+    """
+
+    def __init__(self, maxbytes=256 * 2 ** 20):
+        """
+        - maxbytes: the memory cap of the cached tables, the least recently used ones are evicted beyond it
+        """
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.__tables = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.__tables)
+
+    def clear(self):
+        self.__tables.clear()
+        self.nbytes = 0
+
+    def __lookup(self, key, build):
+        entry = self.__tables.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            entry = build()
+            self.nbytes += _entry_nbytes(entry)
+        else:
+            self.hits += 1
+        # the most recently used entry goes last
+        self.__tables[key] = entry
+        while self.nbytes > self.maxbytes and len(self.__tables) > 1:
+            key, old = self.__tables.popitem(last=False)
+            self.nbytes -= _entry_nbytes(old)
+        return entry
+
+    def table(self, N, K, n):
+        """
+        Returns (kmin, pmf, larger) for the distribution: pmf[j] and larger[j] belong to k = kmin + j,
+        outside of this range the probabilities are negligible. For distributions too wide to tabulate
+        (wider than TAIL_WIDTH) pmf and larger are None, this is remembered as well.
+        """
+        key = (int(N), int(K), int(n))
+
+        def build():
+            lo, hi = _hypergeometric_window(*[np.array([a]) for a in key])
+            if hi[0] - lo[0] + 1 > TAIL_WIDTH:
+                return (int(lo[0]), None, None)
+            i, logp, p = _window_logpmf(lo, hi, _hypergeometric_logratio(*[np.array([a]) for a in key]))
+            return (int(lo[0]), p[0], _largeprobabilities_table(logp[0], p[0]))
+        return self.__lookup(key, build)
+
+    def inverse_cdf(self, M, N, n):
+        """
+        Returns the cumulative distribution over m = 0 .. M of the inverse hypergeometric variable,
+        see inv_hypergeometric_random
+        """
+        key = ('inverse', int(M), int(N), int(n))
+        return self.__lookup(key, lambda: (_inverse_hypergeometric_cdf(*key[1:]), ))[0]
+
+    def sumlargeprobabilities(self, N, K, n, k, random_state=None, midp=False):
+        """
+        The cached equivalent of hypergeometric_sumlargeprobabilities
+        """
+        u = 0.5 if midp else check_random_state(random_state).uniform()
+        kmin, pmf, larger = self.table(N, K, n)
+        if pmf is None:
+            # too wide to tabulate
+            return float(_hypergeometric_sumlargeprobabilities_vectorized([N], [K], [n], [k], [u])[0])
+        j = int(k) - kmin
+        if j < 0 or j >= len(pmf):
+            # a negligible probability, all others are larger
+            return 1.0
+        return min(larger[j] + u * pmf[j], 1.0)
+
+
+def hypergeometric_sumlargeprobabilities_array(N, K, n, k, random_state=None, midp=False, cache=None):
+    """
+    hypergeometric_sumlargeprobabilities for arrays of N, K, n and k, which are broadcast against each other.
+    Returns an array of the broadcast shape.
+
+    Equal (N, K, n) triples are grouped, so each distinct distribution is built only once: distributions shared by
+    at least TABLE_MIN_COUNT elements are tabulated (see hypergeometricCache, a temporary one unless a cache is
+    given), the others, and distributions too wide to tabulate, are computed together by the vectorized functions.
+    """
+    N, K, n, k = [np.asarray(a, dtype=np.int64) for a in np.broadcast_arrays(N, K, n, k)]
+    shape = N.shape
+    N, K, n, k = [a.ravel() for a in (N, K, n, k)]
+    if midp:
+        u = np.full(len(k), 0.5)
+    else:
+        u = check_random_state(random_state).uniform(size=len(k))
+    result = np.empty(len(k))
+    if len(k) == 0:
+        return result.reshape(shape)
+
+    # group the equal triples by sorting them, np.unique(..., axis=0) needs numpy 1.13
+    order = np.lexsort((n, K, N))
+    new = np.concatenate(([True], (np.diff(N[order]) != 0) | (np.diff(K[order]) != 0) | (np.diff(n[order]) != 0)))
+    starts = np.flatnonzero(new)
+    triples = np.column_stack((N, K, n))[order[starts]]
+    counts = np.diff(np.append(starts, len(order)))
+    groups = np.split(order, starts[1:])
+    tabulated = np.zeros(len(k), dtype=bool)
+    if cache is None:
+        cache = hypergeometricCache()
+    lo, hi = _hypergeometric_window(*triples.T)
+    narrow = hi - lo + 1 <= TAIL_WIDTH
+    for g in np.flatnonzero((counts >= TABLE_MIN_COUNT) & narrow):
+        idx = groups[g]
+        kmin, pmf, larger = cache.table(*triples[g])
+        j = k[idx] - kmin
+        inside = (j >= 0) & (j < len(pmf))
+        j = np.clip(j, 0, len(pmf) - 1)
+        result[idx] = np.where(inside, np.minimum(larger[j] + u[idx] * pmf[j], 1.0), 1.0)
+        tabulated[idx] = True
+
+    rest = np.flatnonzero(~tabulated)
+    if len(rest):
+        result[rest] = _hypergeometric_sumlargeprobabilities_vectorized(N[rest], K[rest], n[rest], k[rest], u[rest])
+    return result.reshape(shape)
+
+
+def _marginal_pairs(N, Kvalues, nvalues, lower=False):
+    """
+    The sum of the larger probabilities of zero entries and the probability of zero, for every pair of the given
+    column and row marginals (K-major), computed as the p-values for u = 0 and u = 1. With lower=True the sum of the
+    smaller probabilities instead, the p-value of an empty bin being smaller + (1 - u) * p0.
+    """
+    pairs = Kvalues.size * nvalues.size
+    K, n = np.repeat(Kvalues, nvalues.size), np.tile(nvalues, Kvalues.size)
+    at = [_hypergeometric_sumlargeprobabilities_vectorized(np.full(pairs, N), K, n, np.zeros(pairs), np.full(pairs, u),
+                                                           lower) for u in (0.0, 1.0)]
+    if lower:
+        return at[1], at[0] - at[1]
+    return at[0], at[1] - at[0]
+
+
+def _quantize_block(H2D, xaxis, yaxis, N, seed, pvalues=False):
+    """
+    The p-values of a block of rows of a 2D histogram, given the marginals of the full histogram.
+    The uniform random numbers come from their own stream, seeded per block, a seed of None gives mid-p values.
+    With pvalues=True the result is (SOLP, P), with the p-values P = 1 - SOLP computed directly, for the same
+    random numbers.
+    """
+    if seed is None:
+        u = numpy.full(H2D.shape, 0.5)
+    else:
+        u = numpy.random.RandomState(seed).uniform(size=H2D.shape)
+    SOLP = numpy.empty(H2D.shape)
+    P = numpy.empty(H2D.shape) if pvalues else None
+    # the p-value of an empty bin only depends on its marginals, in sparse histograms there are far fewer distinct
+    # pairs of marginals than empty bins: for those the sum of larger probabilities and the probability of zero
+    # are computed once per pair (as the p-values for u = 0 and u = 1)
+    Kvalues, Kindex = np.unique(xaxis, return_inverse=True)
+    nvalues, nindex = np.unique(yaxis, return_inverse=True)
+    empty = H2D == 0
+    if Kvalues.size * nvalues.size < empty.sum():
+        larger, p0 = _marginal_pairs(N, Kvalues, nvalues)
+        j, i = np.nonzero(empty)
+        pair = Kindex[i] * nvalues.size + nindex[j]
+        SOLP[j, i] = np.minimum(larger[pair] + u[j, i] * p0[pair], 1.0)
+        if pvalues:
+            smaller, p0 = _marginal_pairs(N, Kvalues, nvalues, True)
+            P[j, i] = np.minimum(smaller[pair] + (1 - u[j, i]) * p0[pair], 1.0)
+    else:
+        empty[:] = False
+    j, i = np.nonzero(~empty)
+    SOLP[j, i] = _hypergeometric_sumlargeprobabilities_vectorized(np.full(len(j), N), xaxis[i], yaxis[j],
+                                                                  H2D[j, i], u[j, i])
+    if pvalues:
+        P[j, i] = _hypergeometric_sumlargeprobabilities_vectorized(np.full(len(j), N), xaxis[i], yaxis[j],
+                                                                   H2D[j, i], u[j, i], True)
+        return SOLP, P
+    return SOLP
+
+
+# The histogram, the results and the marginals, shared with the worker processes
+_SHARED = {}
+
+
+def _init_shared(hbuf, outbuf, shape, xaxis, yaxis, N):
+    _SHARED['H2D'] = np.frombuffer(hbuf, dtype=np.int64).reshape(shape)
+    # the SOLP values, followed by the p-values if those are computed
+    _SHARED['results'] = np.frombuffer(outbuf, dtype=np.float64).reshape((-1, ) + shape)
+    _SHARED['marginals'] = (xaxis, yaxis, N)
+
+
+def _quantize_shared(task):
+    start, stop, seed = task
+    xaxis, yaxis, N = _SHARED['marginals']
+    results = _SHARED['results']
+    block = _quantize_block(_SHARED['H2D'][start:stop], xaxis, yaxis[start:stop], N, seed, len(results) > 1)
+    results[:, start:stop] = block
+
+
+def _quantize_rows(H2D, xaxis, yaxis, N, n_jobs, random_state, midp, pvalues=False):
+    """
+    The p-values of all cells of a dense 2D histogram, given the marginals of the full histogram,
+    computed in blocks of rows, see hypergeometric_quantize_2d_correlation_histo. With pvalues=True the result
+    is (SOLP, P), see _quantize_block.
+    """
+    nj, ni = H2D.shape
+    # the blocks do not depend on n_jobs, so neither do their seeds and the result
+    rows = max(1, min(QUANTIZE_BLOCK_BINS, BLOCK_SIZE // 64) // max(ni, 1))
+    starts = range(0, nj, rows)
+    if midp:
+        seeds = [None] * len(starts)
     else:
-        for i in range(m, M, 1):
-            prob = prob * float((n + i + 1) * (M - i)) / float((i + 1) * (N + M - n - i))
-            if prob <= sampleprobability:
-                break
-            result = result + prob
-        prob = sampleprobability
-        for i in range(m, 0, -1):
-            prob = prob * float((i) * (N + M - n - i + 1)) / float((n + i) * (M - i + 1))
-            if prob < sampleprobability:
-                break
-            result = result + prob
-    return result * float(N + 1) / float(N + M + 1)
-
-
-def hypergeometric_quantize_2d_correlation_histo(H2D):
+        seeds = random_state.randint(0, 2 ** 31 - 1, size=len(starts))
+    tasks = [(start, min(start + rows, nj), seed) for start, seed in zip(starts, seeds)]
+    if n_jobs == -1:
+        import multiprocessing
+        n_jobs = multiprocessing.cpu_count()
+    nresults = 2 if pvalues else 1
+    if n_jobs is None or n_jobs < 2 or len(tasks) < 2:
+        results = numpy.empty((nresults, ) + H2D.shape)
+        for start, stop, seed in tasks:
+            results[:, start:stop] = _quantize_block(H2D[start:stop], xaxis, yaxis[start:stop], N, seed, pvalues)
+        return tuple(results) if pvalues else results[0]
+    import multiprocessing
+    import multiprocessing.sharedctypes
+    import ctypes
+    hbuf = multiprocessing.sharedctypes.RawArray(ctypes.c_int64, H2D.size)
+    np.frombuffer(hbuf, dtype=np.int64)[:] = H2D.ravel()
+    outbuf = multiprocessing.sharedctypes.RawArray(ctypes.c_double, nresults * H2D.size)
+    pool = multiprocessing.Pool(n_jobs, _init_shared, (hbuf, outbuf, H2D.shape, xaxis, yaxis, N))
+    try:
+        pool.map(_quantize_shared, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    results = np.frombuffer(outbuf, dtype=np.float64).reshape((nresults, ) + H2D.shape).copy()
+    return tuple(results) if pvalues else results[0]
+
+
+class sparseBinValues(object):
+    """
+    Per-bin values of a scipy.sparse 2D histogram, such as the SOLP values of
+    hypergeometric_quantize_2d_correlation_histo, which take memory for the bins with entries and for the distinct
+    pairs of marginals instead of for the full grid:
+    - nonzero: a scipy.sparse.csr_matrix with the values of the bins with entries
+    - rowindex, colindex: for every row and column the index of its marginal among the distinct ones
+    - low, width: the value of an empty bin is low + u * width of the pair [rowindex, colindex] of its marginals,
+      for a uniform random u, or one half with midp (width is zero for values without random numbers)
+
+    USAGE:
+    SOLP = hypergeometric_quantize_2d_correlation_histo(scipy.sparse.csr_matrix(H2D), compact=True)
+    SOLP.nonzero  # the SOLP values of the bins with entries
+    SOLP.empty([0, 1], [5, 7], random_state=1)  # those of the empty bins (0, 5) and (1, 7)
+    SOLP.toarray(random_state=1)  # all of them, which takes the memory of the full grid
+    """
+
+    def __init__(self, nonzero, rowindex, colindex, low, width, midp=False):
+        self.nonzero = nonzero
+        self.rowindex = rowindex
+        self.colindex = colindex
+        self.low = low
+        self.width = width
+        self.midp = midp
+
+    @property
+    def shape(self):
+        return self.nonzero.shape
+
+    def __random(self, shape, random_state):
+        if self.midp:
+            return numpy.full(shape, 0.5)
+        return check_random_state(random_state).uniform(size=shape)
+
+    def empty(self, rows, cols, random_state=None):
+        """
+        The values of the empty bins (rows[i], cols[i]), see check_random_state for random_state
+        """
+        j, i = self.rowindex[np.asarray(rows)], self.colindex[np.asarray(cols)]
+        return np.minimum(self.low[j, i] + self.__random(j.shape, random_state) * self.width[j, i], 1.0)
+
+    def toarray(self, random_state=None):
+        """
+        The values of all bins as a dense array, see check_random_state for random_state
+        """
+        j, i = np.ix_(self.rowindex, self.colindex)
+        full = np.minimum(self.low[j, i] + self.__random(self.shape, random_state) * self.width[j, i], 1.0)
+        nonzero = self.nonzero.tocoo()
+        full[nonzero.row, nonzero.col] = nonzero.data
+        return full
+
+
+def _sparse_entries(H2D):
+    """
+    A scipy.sparse 2D histogram as a csr_matrix of int64 without duplicate or zero entries, and the row of each entry
+    """
+    H = scipy.sparse.csr_matrix(H2D, dtype=np.int64, copy=True)
+    H.sum_duplicates()
+    H.eliminate_zeros()
+    return H, np.repeat(np.arange(H.shape[0]), np.diff(H.indptr))
+
+
+def _quantize_sparse(H2D, xaxis, yaxis, N, random_state, midp, pvalues=False):
+    """
+    The p-values of a scipy.sparse 2D histogram as a sparseBinValues: the bins with entries straight from the sparse
+    data, the empty bins once per pair of marginals (see _marginal_pairs). With pvalues=True the result is
+    (SOLP, P), with the p-values of the bins with entries computed directly for the same random numbers, and those of
+    the empty bins conservatively, the sum of the smaller probabilities and the probability of zero (u = 0).
+    """
+    H, j = _sparse_entries(H2D)
+    i, k = H.indices, H.data
+    u = numpy.full(len(k), 0.5) if midp else random_state.uniform(size=len(k))
+    Kvalues, colindex = np.unique(xaxis, return_inverse=True)
+    nvalues, rowindex = np.unique(yaxis, return_inverse=True)
+    pairs = (Kvalues.size, nvalues.size)
+
+    def values(lower):
+        nonzero = _hypergeometric_sumlargeprobabilities_vectorized(np.full(len(k), N), xaxis[i], yaxis[j], k, u,
+                                                                   lower)
+        return scipy.sparse.csr_matrix((nonzero, H.indices, H.indptr), shape=H.shape)
+
+    larger, p0 = _marginal_pairs(N, Kvalues, nvalues)
+    SOLP = sparseBinValues(values(False), rowindex, colindex, larger.reshape(pairs).T, p0.reshape(pairs).T, midp)
+    if not pvalues:
+        return SOLP
+    smaller, p0 = _marginal_pairs(N, Kvalues, nvalues, True)
+    low = np.minimum(smaller + p0, 1.0).reshape(pairs).T
+    return SOLP, sparseBinValues(values(True), rowindex, colindex, low, np.zeros_like(low), True)
+
+
+def adjust_pvalues(pvalues, correction='bh', counts=None):
+    """
+    Adjusts an array of p-values for testing all of them at once. With correction='bonferroni' they are multiplied
+    by their number, with correction='bh' they become the Benjamini-Hochberg adjusted p-values, which control the
+    false discovery rate. Returns an array of the same shape.
+    counts, if given, is the number of tests with each p-value (one by default).
+    """
+    p = np.asarray(pvalues, dtype=float)
+    counts = np.ones(p.size) if counts is None else np.asarray(counts, dtype=float).ravel()
+    m = counts.sum()
+    if correction == 'bonferroni':
+        return np.minimum(p * m, 1.0)
+    if correction != 'bh':
+        raise ValueError("Unknown correction " + str(correction) + ", choose from " + str(CORRECTIONS))
+    order = np.argsort(p, axis=None, kind='mergesort')
+    # a p-value counting for several tests takes the rank of the last of them
+    scaled = p.ravel()[order] * m / np.maximum(np.cumsum(counts[order]), 1)
+    adjusted = np.empty(p.size)
+    # the adjusted p-value of the i-th smallest is the smallest scaled value from i on
+    adjusted[order] = np.minimum(np.minimum.accumulate(scaled[::-1])[::-1], 1.0)
+    return adjusted.reshape(p.shape)
+
+
+def _correlation_summary(H2D, pvalues, xaxis, yaxis, N, rows, cols, correction, top, alpha):
+    """
+    The summary of hypergeometric_quantize_2d_correlation_histo for the computed rows and columns,
+    given their p-values
+    """
+    adjusted = pvalues if correction is None else adjust_pvalues(pvalues, correction)
+    significant = adjusted < alpha
+    candidates = np.flatnonzero(significant)
+    j, i = np.unravel_index(candidates, pvalues.shape)
+    mean, var = _hypergeometric_moments(N, xaxis[i], yaxis[j])[:2]
+    # p-values which underflow to zero are ranked by the distance to the expected entries, in standard deviations
+    distance = np.abs(H2D[j, i] - mean) / np.sqrt(np.maximum(var, 1e-300))
+    candidates = candidates[np.lexsort((-distance, pvalues.flat[candidates]))][:top]
+    j, i = np.unravel_index(candidates, pvalues.shape)
+    expected = yaxis[j] * xaxis[i] / float(max(N, 1))
+    cells = zip(rows[j], cols[i], H2D[j, i], expected, pvalues[j, i], adjusted[j, i])
+    return {'pvalues': adjusted, 'significant': significant, 'top': cells, 'ntests': pvalues.size}
+
+
+def _sparse_summary(H2D, P, xaxis, yaxis, N, correction, top, alpha):
+    """
+    The summary of hypergeometric_quantize_2d_correlation_histo for scipy.sparse input, given the p-values P of
+    _quantize_sparse. The empty bins are tested per pair of marginals, which counts as one test for each of its
+    empty bins in the non-empty rows and columns.
+    """
+    H, j = _sparse_entries(H2D)
+    i = H.indices
+    npairs, Kpairs = P.low.shape
+    tested = np.outer(np.bincount(P.rowindex[yaxis > 0], minlength=npairs),
+                      np.bincount(P.colindex[xaxis > 0], minlength=Kpairs))
+    tested -= np.bincount(P.rowindex[j] * Kpairs + P.colindex[i], minlength=tested.size).reshape(tested.shape)
+    # the bins with entries first, then the pairs of marginals
+    b, a = np.divmod(np.arange(tested.size), Kpairs)
+    Kvalues, nvalues = np.zeros(Kpairs, dtype=np.int64), np.zeros(npairs, dtype=np.int64)
+    Kvalues[P.colindex], nvalues[P.rowindex] = xaxis, yaxis
+    K, n = np.concatenate([xaxis[i], Kvalues[a]]), np.concatenate([yaxis[j], nvalues[b]])
+    k = np.concatenate([H.data, np.zeros(tested.size, dtype=np.int64)])
+    pvalues = np.concatenate([P.nonzero.data, P.low.ravel()])
+    counts = np.concatenate([np.ones(len(j), dtype=np.int64), tested.ravel()])
+    adjusted = pvalues.copy()
+    if correction is not None:
+        adjusted[counts > 0] = adjust_pvalues(pvalues[counts > 0], correction, counts[counts > 0])
+    candidates = np.flatnonzero((counts > 0) & (adjusted < alpha))
+    mean, var = _hypergeometric_moments(N, K[candidates], n[candidates])[:2]
+    distance = np.abs(k[candidates] - mean) / np.sqrt(np.maximum(var, 1e-300))
+    candidates = candidates[np.lexsort((-distance, pvalues[candidates]))]
+    cells = []
+    for c in candidates:
+        if top is not None and len(cells) >= top:
+            break
+        if c < len(j):
+            cell = [(j[c], i[c])]
+        else:
+            # all empty bins of the pair, up to the number still needed
+            need = None if top is None else top - len(cells)
+            cols = np.flatnonzero((P.colindex == a[c - len(j)]) & (xaxis > 0))
+            cell = []
+            for row in np.flatnonzero((P.rowindex == b[c - len(j)]) & (yaxis > 0)):
+                empty = np.setdiff1d(cols, H.indices[H.indptr[row]:H.indptr[row + 1]], assume_unique=True)
+                cell.extend(zip([row] * len(empty), empty))
+                if need is not None and len(cell) >= need:
+                    break
+            cell = cell[:need]
+        expected = n[c] * K[c] / float(max(N, 1))
+        cells.extend((row, col, k[c], expected, pvalues[c], adjusted[c]) for row, col in cell)
+    low = adjusted[len(j):].reshape(P.low.shape)
+    nonzero = scipy.sparse.csr_matrix((adjusted[:len(j)], H.indices, H.indptr), shape=H.shape)
+    return {'pvalues': sparseBinValues(nonzero, P.rowindex, P.colindex, low, P.width, True), 'top': cells,
+            'ntests': int(counts[counts > 0].sum())}
+
+
+def hypergeometric_quantize_2d_correlation_histo(H2D, vectorized=True, n_jobs=1, random_state=None, midp=False,
+                                                 compact=False, correction=None, top=None, alpha=0.05):
     """
     Takes a 2D histogram of entries (unnormalized and unweighted)
     and determines if the two variables/axes are uncorrelated,
@@ -120,28 +926,140 @@ def hypergeometric_quantize_2d_correlation_histo(H2D):
     entries in bin (x,y) can be expected from all entries in x
     and all entries in y.
     Returns a 2D histogram of p-values for each bin
+
+    H2D may be a numpy array or a scipy.sparse matrix. The bins of rows and columns without entries have a known
+    p-value, a uniform random number (0.5 with midp), only the other bins are computed. With compact=True the result
+    is (SOLP, rows, cols): the p-values of the rows and columns with entries and their indices, so that neither the
+    computation nor the result takes memory for the empty rows and columns.
+    For scipy.sparse input the bins with entries are computed from the sparse data, and the empty bins once per
+    distinct pair of row and column marginals, in one process. With compact=True the result is then a sparseBinValues,
+    which takes memory for the entries and the pairs of marginals only. Note that without compact=True the result, and
+    its random numbers, take the memory of the full grid, as for dense input.
+
+    By default all cells are computed at once, with log-probability arrays over the relevant range of each cell,
+    which gives the same values as calling hypergeometric_sumlargeprobabilities for every cell (vectorized=False).
+    The rows are processed in blocks, each drawing its random numbers from its own stream seeded from
+    random_state (see check_random_state), so the result for a given seed does not depend on n_jobs.
+    With midp=True the result is the deterministic mid-p value, which does not use random numbers at all.
+    With n_jobs > 1 (or -1 for all cores) the blocks are spread over a pool of processes, which share the histogram
+    and the result in memory instead of receiving copies.
+
+    With a correction ('bh' or 'bonferroni', see adjust_pvalues) or top set, a summary dict is returned after the
+    result, computed from the p-values (1 - SOLP, for the same random numbers) of the bins in the non-empty rows and
+    columns, the tests. These are summed directly from the probabilities smaller than that of the bin, so that the
+    most significant bins keep distinct p-values instead of rounding to zero:
+    - pvalues: the adjusted p-values (unadjusted without correction), 1 for the bins that are not tested
+    - significant: the mask of the adjusted p-values below alpha
+      For scipy.sparse input the empty bins are tested with their conservative p-value, the sum of the smaller
+      probabilities and the probability of zero, which only depends on their marginals. With compact=True pvalues is
+      then a sparseBinValues and there is no significant mask.
+    - top: the significant bins with the smallest p-values, at most top of them, as a list of
+      (row, column, entries, expected entries, p-value, adjusted p-value), most significant first
+    - ntests: the number of tests
     """
-    xaxis = H2D.sum(0)
-    yaxis = H2D.sum(1)
-    SOLP = numpy.zeros(shape=H2D.shape)
-    ni = H2D.shape[1]
-    nj = H2D.shape[0]
-    N = int(H2D.sum())
-    for i in range(0, ni):
-        for j in range(0, nj):
-            p = hypergeometric_sumlargeprobabilities(N, int(xaxis[i]), int(yaxis[j]), int(H2D[j][i]))
-            SOLP[j][i] = p
-    return SOLP
+    sparse = scipy.sparse.issparse(H2D)
+    xaxis = np.asarray(H2D.sum(0)).ravel().astype(np.int64)
+    yaxis = np.asarray(H2D.sum(1)).ravel().astype(np.int64)
+    N = int(xaxis.sum())
+    summarize = correction is not None or top is not None
+    if vectorized and sparse:
+        random_state = check_random_state(random_state)
+        results = _quantize_sparse(H2D, xaxis, yaxis, N, random_state, midp, summarize)
+        SOLP, P = results if summarize else (results, None)
+        result = (SOLP, ) if compact else (SOLP.toarray(random_state), )
+    elif vectorized:
+        random_state = check_random_state(random_state)
+        rows, cols = np.flatnonzero(yaxis), np.flatnonzero(xaxis)
+        H = np.asarray(H2D)[np.ix_(rows, cols)].astype(np.int64)
+        results = _quantize_rows(H, xaxis[cols], yaxis[rows], N, n_jobs, random_state, midp, summarize)
+        SOLP, P = results if summarize else (results, None)
+        if compact:
+            result = (SOLP, rows, cols)
+        else:
+            if midp:
+                full = numpy.full(H2D.shape, 0.5)
+            else:
+                full = random_state.uniform(size=H2D.shape)
+            full[np.ix_(rows, cols)] = SOLP
+            result = (full, )
+    else:
+        if sparse:
+            H2D = H2D.toarray()
+        random_state = check_random_state(random_state)
+        full = numpy.zeros(shape=H2D.shape)
+        fullP = numpy.zeros(shape=H2D.shape)
+        ni = H2D.shape[1]
+        nj = H2D.shape[0]
+        for i in range(0, ni):
+            for j in range(0, nj):
+                # as hypergeometric_sumlargeprobabilities, keeping the random number for the p-value
+                u = 0.5 if midp else random_state.uniform()
+                cell = ([N], [int(xaxis[i])], [int(yaxis[j])], [int(H2D[j][i])], [u])
+                full[j][i] = _hypergeometric_sumlargeprobabilities_scalar(*[c[0] for c in cell])
+                if summarize:
+                    fullP[j][i] = _hypergeometric_sumlargeprobabilities_vectorized(*cell, lower=True)[0]
+        rows, cols = np.flatnonzero(yaxis), np.flatnonzero(xaxis)
+        H = np.asarray(H2D)[np.ix_(rows, cols)]
+        SOLP = full[np.ix_(rows, cols)]
+        P = fullP[np.ix_(rows, cols)]
+        result = (SOLP, rows, cols) if compact else (full, )
+    if summarize and vectorized and sparse:
+        summary = _sparse_summary(H2D, P, xaxis, yaxis, N, correction, top, alpha)
+        if not compact:
+            summary['pvalues'] = summary['pvalues'].toarray()
+            summary['significant'] = summary['pvalues'] < alpha
+        result += (summary, )
+    elif summarize:
+        summary = _correlation_summary(H, P, xaxis[cols], yaxis[rows], N, rows, cols, correction, top, alpha)
+        if not compact:
+            pvalues = numpy.ones(result[0].shape)
+            pvalues[np.ix_(rows, cols)] = summary['pvalues']
+            summary['pvalues'] = pvalues
+            summary['significant'] = pvalues < alpha
+        result += (summary, )
+    return result if len(result) > 1 else result[0]
 
 
-def inv_hypergeometric_random(M, N, n):
-    """Helper function that generates a random inverse hypergeometric variable"""
-    p = np.random.uniform()
-    prob = scipy.stats.hypergeom.pmf(0, N + M, n, M) * float(N + 1) / float(N + M + 1)
-    sumprob = prob
-    for m in range(0, M, 1):
-        if sumprob > p:
-            break
-        prob = prob * float((n + m + 1) * (M - m)) / float((m + 1) * (N + M - n - m))
-        sumprob += prob
+def hypergeometric_quantize_2d_correlation_th2(histo, name=None, **kwargs):
+    """
+    hypergeometric_quantize_2d_correlation_histo for a ROOT TH2 (for example from rootnotes.TH2D), with the x bins as
+    columns and the y bins as rows. The bin contents are read as a numpy view of the histogram buffer, without the
+    under- and overflow bins (see roothistos), and the p-values are written into a new TH2D with the same binning
+    in one go. Returns the TH2D (named name, by default the name of histo + '_solp'), followed by the summary
+    if one is requested. The keyword arguments are passed on, compact is not supported.
+    """
+    import ROOT
+    if kwargs.get('compact'):
+        raise ValueError("The result of a TH2 adapter covers all bins, compact is not supported")
+    counts = np.rint(roothistos.th2_contents(histo).T).astype(np.int64)
+    result = hypergeometric_quantize_2d_correlation_histo(counts, **kwargs)
+    SOLP = result[0] if isinstance(result, tuple) else result
+    xedges = np.ascontiguousarray(roothistos.axis_edges(histo.GetXaxis()), dtype=np.float64)
+    yedges = np.ascontiguousarray(roothistos.axis_edges(histo.GetYaxis()), dtype=np.float64)
+    if name is None:
+        name = histo.GetName() + '_solp'
+    out = ROOT.TH2D(name, histo.GetTitle(), len(xedges) - 1, xedges, len(yedges) - 1, yedges)
+    roothistos.th2_contents(out)[:] = SOLP.T
+    out.SetEntries(SOLP.size)
+    if isinstance(result, tuple):
+        return (out, ) + result[1:]
+    return out
+
+
+def inv_hypergeometric_random(M, N, n, random_state=None, size=None, cache=None):
+    """
+    Helper function that generates random inverse hypergeometric variables: the number m of elements of a specific
+    type in a second sample of M elements, after a first sample of N elements contained n of them.
+    Draws from random_state (see check_random_state). Returns one value, or an array of shape size.
+    The cumulative distribution is built once per call, or looked up in cache (a hypergeometricCache)
+    for repeated parameters, and sampled with one uniform number per value.
+    """
+    if cache is not None:
+        cdf = cache.inverse_cdf(M, N, n)
+    else:
+        cdf = _inverse_hypergeometric_cdf(int(M), int(N), int(n))
+    p = check_random_state(random_state).uniform(size=size)
+    m = np.minimum(np.searchsorted(cdf, p, side='right'), len(cdf) - 1)
+    if size is None:
+        return int(m)
     return m
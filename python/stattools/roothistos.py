@@ -0,0 +1,91 @@
+##############################################################################
+#
+# Copyright 2016 KPMG Advisory N.V. (unless otherwise stated)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+##############################################################################
+"""
+Helpers which view the internal buffers of ROOT histograms as numpy arrays, without copying them bin by bin.
+ROOT itself is not imported here, the functions only use the methods of the histogram objects they are given.
+
+The views share memory with the histogram: they are only valid as long as the histogram exists and is not rebinned,
+and writing into them changes the histogram.
+"""
+import numpy as np
+
+# The storage classes of the ROOT histograms and the matching numpy types, TH1D derives from TArrayD, etc.
+STORAGE_TYPES = [('TArrayD', np.float64), ('TArrayF', np.float32), ('TArrayI', np.int32),
+                 ('TArrayS', np.int16), ('TArrayC', np.int8), ('TArrayL64', np.int64)]
+
+
+def buffer_as_array(buf, size, dtype=np.float64):
+    """
+    View a ROOT (PyROOT) pointer buffer of known size as a numpy array
+    """
+    if hasattr(buf, 'SetSize'):
+        # older PyROOT buffers do not know their own length
+        buf.SetSize(size)
+    return np.frombuffer(buf, dtype=dtype, count=size)
+
+
+def storage_type(histo):
+    """
+    The numpy type of the bin contents of a ROOT histogram
+    """
+    for cls, dtype in STORAGE_TYPES:
+        if histo.InheritsFrom(cls):
+            return dtype
+    raise TypeError("Cannot determine the storage type of " + histo.ClassName())
+
+
+def cells(histo):
+    """
+    All cells of a ROOT histogram, including the under- and overflow bins, in the order ROOT stores them
+    """
+    return buffer_as_array(histo.GetArray(), histo.GetNcells(), storage_type(histo))
+
+
+def th1_contents(histo):
+    """
+    The bin contents of a TH1, without the under- and overflow bins
+    """
+    return cells(histo)[1:-1]
+
+
+def th2_contents(histo):
+    """
+    The bin contents of a TH2, without the under- and overflow bins, as an array indexed [xbin, ybin]
+    """
+    nx, ny = histo.GetNbinsX(), histo.GetNbinsY()
+    # ROOT stores bin (ix, iy) at ix + (nx + 2) * iy
+    return cells(histo).reshape(ny + 2, nx + 2)[1:-1, 1:-1].T
+
+
+def th1_integral(histo):
+    """
+    The normalized cumulative integral of a TH1, as computed by ROOT: element i holds the integral up to and
+    including bin i, element 0 is zero
+    """
+    return buffer_as_array(histo.GetIntegral(), histo.GetNbinsX() + 1)
+
+
+def axis_edges(axis):
+    """
+    The bin edges of a ROOT axis, for fixed as well as variable binning
+    """
+    nbins = axis.GetNbins()
+    xbins = axis.GetXbins()
+    if xbins.GetSize() == 0:
+        return np.linspace(axis.GetXmin(), axis.GetXmax(), nbins + 1)
+    return buffer_as_array(xbins.GetArray(), nbins + 1)
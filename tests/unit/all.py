@@ -23,9 +23,11 @@ import testpythonimport
 import checkpep8
 import pep8functions
 import installlibunits
+import statlibunits
 import base
 
-mods = [testversion, pep8functions, checkpep8, testpythonimport, installlibunits, license, pyfilenames]
+mods = [testversion, pep8functions, checkpep8, testpythonimport, installlibunits, statlibunits, license,
+        pyfilenames]
 
 if __name__ == "__main__":
     base.parallel(mods)
@@ -0,0 +1,196 @@
+##############################################################################
+#
+# Copyright 2016 KPMG Advisory N.V. (unless otherwise stated)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+##############################################################################
+import unittest
+import base
+import os
+import sys
+
+# the statistics libraries import their siblings directly
+for lib in ['stattools', 'correlograms']:
+    sys.path.append(os.path.realpath(os.path.dirname(os.path.realpath(__file__)) + '/../../python/' + lib))
+
+
+def exact_midp(N, K, n, k):
+    """
+    The mid-p value of hypergeometric_sumlargeprobabilities as an exact fraction, from the binomial coefficients
+    """
+    from fractions import Fraction
+    from scipy.special import comb
+    total = comb(N, n, exact=True)
+    p = [Fraction(comb(K, i, exact=True) * comb(N - K, n - i, exact=True), total) for i in range(min(K, n) + 1)]
+    # a probability equal to p(k) counts as larger left of k only
+    larger = sum(pi for i, pi in enumerate(p) if pi > p[k] or (pi == p[k] and i < k))
+    return larger + p[k] / 2
+
+
+def lagged_correlation(series1, series2, lags):
+    """
+    The cross correlations of two series term by term, with the shorter one padded with zeros
+    """
+    import numpy as np
+    n = max(len(series1), len(series2))
+    x = np.append(series1, np.zeros(n - len(series1)))
+    y = np.append(series2, np.zeros(n - len(series2)))
+    x, y = x - x.mean(), y - y.mean()
+    norm = n * x.std() * y.std()
+    return np.array([(x[:n - h] * y[h:]).sum() / norm if h < n else 0.0 for h in lags])
+
+
+class TestHypergeometric(unittest.TestCase):
+
+    def runTest(self):
+        """
+        Check the mid-p values against exact fractions, and the p-values of wide distributions at their mode
+        """
+        import numpy as np
+        import hypergeometrictools as ht
+        cases = [(N, K, n, k) for N in [1, 7, 20, 60] for K in range(0, N + 1, max(1, N // 6))
+                 for n in range(0, N + 1, max(1, N // 5)) for k in range(max(0, n + K - N), min(K, n) + 1)]
+        exact = np.array([float(exact_midp(*case)) for case in cases])
+        N, K, n, k = [np.array(c) for c in zip(*cases)]
+        scalar = np.array([ht.hypergeometric_sumlargeprobabilities(*case, midp=True) for case in cases])
+        self.assertTrue(np.allclose(scalar, exact, rtol=0, atol=1e-12), "scalar mid-p values differ from exact")
+        array = ht.hypergeometric_sumlargeprobabilities_array(N, K, n, k, midp=True)
+        self.assertTrue(np.allclose(array, exact, rtol=0, atol=1e-12), "array mid-p values differ from exact")
+        cache = ht.hypergeometricCache()
+        cached = ht.hypergeometric_sumlargeprobabilities_array(N, K, n, k, midp=True, cache=cache)
+        self.assertTrue(np.allclose(cached, exact, rtol=0, atol=1e-12), "cached mid-p values differ from exact")
+        # too wide to sum term by term: the p-value and its complement still add up to one around the mode
+        N, K, n = 10 ** 12, 5 * 10 ** 11, 10 ** 10
+        for k in [4999999999, 5 * 10 ** 9, 5000000001]:
+            cell = [np.array([v]) for v in (N, K, n, k, 0.5)]
+            total = (ht._hypergeometric_sumlargeprobabilities_vectorized(*cell)
+                     + ht._hypergeometric_sumlargeprobabilities_vectorized(*cell, lower=True))
+            self.assertAlmostEqual(total[0], 1.0, 8, "SOLP and p-value do not add up to one at k=" + str(k))
+
+
+class TestQuantize(unittest.TestCase):
+
+    def runTest(self):
+        """
+        Check the vectorized 2D correlation test against the cell by cell one, for dense and sparse input,
+        and that its result does not depend on n_jobs
+        """
+        import numpy as np
+        import scipy.sparse
+        import hypergeometrictools as ht
+        rng = np.random.RandomState(42)
+        H = rng.poisson(3.0, size=(12, 15)) * (rng.uniform(size=(12, 15)) < 0.5)
+        H[4] = 0
+        H[:, 9] = 0
+        quantize = ht.hypergeometric_quantize_2d_correlation_histo
+        reference, rsummary = quantize(H, vectorized=False, midp=True, correction='bh', top=5)
+        SOLP, summary = quantize(H, midp=True, correction='bh', top=5)
+        self.assertTrue(np.allclose(SOLP, reference, rtol=0, atol=1e-12), "vectorized mid-p values differ")
+        self.assertTrue(np.allclose(summary['pvalues'], rsummary['pvalues'], rtol=0, atol=1e-12),
+                        "vectorized adjusted p-values differ")
+        self.assertEqual([c[:2] for c in summary['top']], [c[:2] for c in rsummary['top']],
+                         "vectorized top bins differ")
+        sparse = quantize(scipy.sparse.csr_matrix(H), midp=True)
+        self.assertTrue(np.allclose(sparse, reference, rtol=0, atol=1e-12), "sparse mid-p values differ")
+        compact = quantize(scipy.sparse.csr_matrix(H), midp=True, compact=True)
+        self.assertTrue(np.allclose(compact.toarray(), reference, rtol=0, atol=1e-12),
+                        "compact sparse mid-p values differ")
+        serial = quantize(H, random_state=7)
+        parallel = quantize(H, random_state=7, n_jobs=2)
+        self.assertTrue(np.array_equal(serial, parallel), "the result depends on n_jobs")
+        self.assertTrue(((serial >= 0) & (serial <= 1)).all(), "SOLP values outside [0, 1]")
+
+
+class TestQuantiles(unittest.TestCase):
+
+    def runTest(self):
+        """
+        Check the sorted quantiles against the spline ones, batches against single curves,
+        and the streaming quantiles against a fresh computation
+        """
+        import numpy as np
+        from confidencecalc import quantileCalc, streamingQuantileCalc
+        x = np.linspace(-6, 6, 2001)
+        Y = np.array([np.exp(-0.5 * x ** 2) + 0.5 * np.exp(-0.5 * ((x - 2.5) / 0.5) ** 2),
+                      np.exp(-0.5 * x ** 2), np.exp(-np.abs(x))])
+        levels = [0.682, 0.954]
+        for y in Y:
+            spline = quantileCalc(x, y, levels=levels).getquantiles()
+            ordered = quantileCalc(x, y, levels=levels, method="sorted").getquantiles()
+            for level in levels:
+                self.assertAlmostEqual(spline[level][0], ordered[level][0], 4, "sorted and spline levels differ")
+                self.assertEqual(spline[level][1].shape, ordered[level][1].shape, "different number of intervals")
+                self.assertTrue(np.allclose(spline[level][1], ordered[level][1], atol=1e-3),
+                                "sorted and spline intervals differ")
+        ylevels, intervals = quantileCalc.batch(x, Y, levels=levels)
+        single = [quantileCalc(x, y, levels=levels, method="sorted").getquantiles() for y in Y]
+        self.assertTrue(np.allclose(ylevels, [[q[level][0] for level in levels] for q in single], rtol=1e-12),
+                        "batch levels differ from single curves")
+        pylevels, pintervals = quantileCalc.batch(x, Y, levels=levels, n_jobs=2)
+        self.assertTrue(np.allclose(ylevels, pylevels, rtol=1e-12), "batch levels depend on n_jobs")
+        rng = np.random.RandomState(1)
+        centres = np.linspace(-5, 5, 501)
+        streaming = streamingQuantileCalc(centres, levels=levels)
+        for i in range(5):
+            streaming.update(np.searchsorted(centres, rng.normal(size=2000)).clip(0, 500))
+            fresh = streamingQuantileCalc(centres, counts=streaming.counts, levels=levels)
+            for level in levels:
+                ylevel, found = streaming.getquantiles()[level]
+                flevel, expected = fresh.getquantiles()[level]
+                self.assertAlmostEqual(ylevel, flevel, 12, "streaming level differs after update " + str(i))
+                self.assertTrue(np.allclose(found, expected), "streaming intervals differ after update " + str(i))
+
+
+class TestCorrelations(unittest.TestCase):
+
+    def runTest(self):
+        """
+        Check the cross correlations, chunked and as a matrix, against the term by term formula
+        """
+        import numpy as np
+        import correlations as cc
+        rng = np.random.RandomState(3)
+        a = rng.normal(size=500).cumsum()
+        b = rng.normal(size=430) + np.sin(np.arange(430) / 7.0)
+        lags = np.arange(1, 501, 3)
+        expected = lagged_correlation(a, b, lags)
+        for method in ['direct', 'fft']:
+            r = cc.crosscorrelation(a, b, max_lag=500, lag_step=3, method=method)
+            self.assertTrue(np.allclose(r, expected, atol=1e-10), "crosscorrelation differs with " + method)
+            r = cc.crosscorrelation_chunked(a, b, 500, lag_step=3, chunk_size=64, method=method)
+            self.assertTrue(np.allclose(r, expected, atol=1e-10), "chunked crosscorrelation differs with " + method)
+        data = rng.normal(size=(300, 4)).cumsum(axis=0)
+        lags = np.arange(1, 41, 2)
+        for method in ['direct', 'fft']:
+            matrix = cc.crosscorrelation_matrix(data, 40, lag_step=2, method=method)
+            for i in range(4):
+                for j in range(4):
+                    self.assertTrue(np.allclose(matrix[i, j], lagged_correlation(data[:, i], data[:, j], lags),
+                                                atol=1e-10), "crosscorrelation_matrix differs with " + method)
+        parallel = cc.crosscorrelation_matrix(data, 40, lag_step=2, n_jobs=2)
+        self.assertTrue(np.allclose(parallel, cc.crosscorrelation_matrix(data, 40, lag_step=2), rtol=0, atol=1e-14),
+                        "crosscorrelation_matrix depends on n_jobs")
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(TestHypergeometric())
+    suite.addTest(TestQuantize())
+    suite.addTest(TestQuantiles())
+    suite.addTest(TestCorrelations())
+    return suite
+
+
+if __name__ == "__main__":
+    base.run(suite())